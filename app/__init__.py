@@ -1,39 +1,29 @@
 import logging
 import os
-import time
 import json
 
 from flask_restx import Api
-from sqlalchemy import create_engine, MetaData
 from celery import Celery
 from celery import Task
+from celery.signals import worker_init, worker_process_shutdown, setup_logging
 from flask import Flask
 
-from os import listdir
-from os.path import isdir, isfile, join
+from os.path import isdir, isfile
 
 from flask_cors import CORS
+from kombu import Queue
 
 from Crypto.PublicKey import RSA  # provided by pycryptodome
 
+from app.database import get_engine, engine_options_from_config
+from app.schema import get_registry
+from app.scheduling import parcel_queues, shards_from_config
+from app.metrics import start_metrics_server
+from app.logs import configure_logging, stop_listener
+
 # Create the logger
 log = logging.getLogger('app')
 
-# Set the default logger level as debug
-log.setLevel(logging.DEBUG)
-
-# Create the logger formatter
-fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
-
-# Get the handler
-h = logging.StreamHandler()
-
-# Set the formatter
-h.setFormatter(fmt)
-
-# Add the handler to the logger
-log.addHandler(h)
-
 flask_app = None
 
 
@@ -41,7 +31,7 @@ def create_app() -> Flask:
     app_root = os.getcwd()
 
     # Log a debug message
-    log.debug("App root:" + app_root)
+    log.debug("App root:%s", app_root)
 
     # Create the Flask application
     app = Flask(__name__)
@@ -60,8 +50,11 @@ def create_app() -> Flask:
     # Override config.json configuration with environmental variables
     app.config.from_prefixed_env()
 
+    # Configure the logging of the process
+    configure_logging(app.config)
+
     # Log a debug message
-    log.debug("app.config: " + str(app.config))
+    log.debug("app.config: %s", app.config)
 
     # Check the private key
     if not isfile(app.config['PRIVATE_KEY_FILENAME']):
@@ -83,7 +76,7 @@ def create_app() -> Flask:
         # Close the file
         f.close()
 
-        log.info("Created private key: " + app.config['PRIVATE_KEY_FILENAME'])
+        log.info("Created private key: %s", app.config['PRIVATE_KEY_FILENAME'])
 
     # Check the public key
     if not isfile(app.config['PUBLIC_KEY_FILENAME']):
@@ -126,7 +119,7 @@ def create_app() -> Flask:
         f.close()
 
         # Log info message
-        log.info("Created public key: " + app.config['PUBLIC_KEY_FILENAME'])
+        log.info("Created public key: %s", app.config['PUBLIC_KEY_FILENAME'])
 
     # Check the public key directory root
     if not isdir(app.config['PUBLIC_KEY_ROOT']):
@@ -137,79 +130,57 @@ def create_app() -> Flask:
         os.mkdir(app.config['PUBLIC_KEY_ROOT'])
 
         # Log info message
-        log.info("Created public key directory root: " + app.config['PUBLIC_KEY_ROOT'])
+        log.info("Created public key directory root: %s", app.config['PUBLIC_KEY_ROOT'])
 
     # Check if the database backend is up and running
 
-    # Connect the database server
-    engine = create_engine(app.config["CONNECTION_STRING"], echo=False)
-
-    # Retrieve the metadata
-    metadata = MetaData()
+    # Get the process-wide engine (shared by the routes and the Celery tasks)
+    engine = get_engine(app.config["CONNECTION_STRING"], engine_options_from_config(app.config))
 
     try:
-        # Create the actual connection
-        metadata.create_all(engine)
+        # Create the actual connection and load the existing tables once for this process (and its forks)
+        get_registry(engine).load()
 
     except Exception as exception:
         # Log the error message
-        log.error("Database connection error. Check the connection string: " +
-                  app.config["CONNECTION_STRING"] + ": " +
-                  str(exception))
+        log.error("Database connection error. Check the connection string: %s: %s",
+                  app.config["CONNECTION_STRING"], exception)
 
         # Exit with error code
         exit(-1)
 
     # Log the info message
-    log.info("Private key: " + app.config['PRIVATE_KEY_FILENAME'])
-    log.info("Public key: " + app.config['PUBLIC_KEY_FILENAME'])
-    log.info("Public key directory root: " + app.config['PUBLIC_KEY_ROOT'])
-    log.info("Database connection string: " + app.config['CONNECTION_STRING'])
+    log.info("Private key: %s", app.config['PRIVATE_KEY_FILENAME'])
+    log.info("Public key: %s", app.config['PUBLIC_KEY_FILENAME'])
+    log.info("Public key directory root: %s", app.config['PUBLIC_KEY_ROOT'])
+    log.info("Database connection string: %s", app.config['CONNECTION_STRING'])
 
     # Initialize the Celery app
     celery_init_app(app)
 
-    # Process the files in the media folder
-    def process_files(config):
-        # Import the process file
-        from app.tasks import process_file_task
-
-        # Log the info message
-        log.info("Start " + time.strftime("%A, %d. %B %Y %I:%M:%S %p") + "...")
-
-        # Get the media root path
-        media_root = config["MEDIA_ROOT"]
-
-        # Get all directories in the media root (each directory is a vessel uuid)
-        directories = [f for f in listdir(media_root) if isdir(join(media_root, f))]
-
-        # For each directory in the directory list...
-        for directory in directories:
-
-            # Create the directory path
-            directory_root = media_root + "/" + directory
+    with app.app_context():
+        from . import routes
 
-            # Create the file list. Each file contains a data parcel.
-            files = [f for f in listdir(directory_root) if isfile(join(directory_root, f))]
+    # Enqueue the recovery of the files still to be processed, the scan runs in a Celery worker
+    recover_backlog(app)
 
-            # Fir each file in the file list
-            for file_item in files:
-                # Log an info message
-                log.info("Processing:" + media_root + "," + directory + "," + file_item)
+    return app
 
-                # Processing the file is potentially time-consuming, enqueue the process
-                process_file_task.delay(directory, file_item)
 
-        # Log an info message
-        log.info("... " + time.strftime("%A, %d. %B %Y %I:%M:%S %p") + " finish.")
+def recover_backlog(app: Flask):
+    # Import the recovery task
+    from app.tasks import recover_backlog_task
 
-    with app.app_context():
-        from . import routes
+    try:
+        # Enqueue the recovery (it is skipped if another replica is running it or has just completed it)
+        result = recover_backlog_task.delay()
 
-    # Process files still to be processed
-    process_files(app.config)
+        # Log the info message
+        log.info("Backlog recovery enqueued: %s", result.id)
 
-    return app
+    except Exception as exception:
+        # Log the error message
+        log.error("Backlog recovery not enqueued: %s", exception)
 
 
 def celery_init_app(app: Flask) -> Celery:
@@ -223,6 +194,39 @@ def celery_init_app(app: Flask) -> Celery:
         task_cls=FlaskTask
     )
     celery_app.config_from_object(app.config["CELERY"])
+
+    # Use the logging configuration of the application in the workers too
+    setup_logging.connect(lambda **kwargs: configure_logging(app.config), weak=False)
+
+    # Write the queued log records before a worker process exits
+    worker_process_shutdown.connect(lambda **kwargs: stop_listener(), weak=False)
+
+    # Consume the parcel queues (priority and vessel shards) besides the default queue, unless configured
+    if not celery_app.conf.task_queues:
+        celery_app.conf.task_queues = [Queue(celery_app.conf.task_default_queue)] + \
+                                      parcel_queues(shards_from_config(app.config))
+
+    # Schedule the partition maintenance (run by celery beat) if the path tables are partitioned
+    if app.config.get("PARTITIONING", {}).get("enabled", False):
+        celery_app.conf.beat_schedule = dict(celery_app.conf.beat_schedule or {})
+        celery_app.conf.beat_schedule["maintain-partitions"] = {
+            "task": "app.tasks.maintain_partitions_task",
+            "schedule": app.config["PARTITIONING"].get("maintenance_interval", 86400)
+        }
+
+    # Schedule the rollups of the numeric paths (run by celery beat) if enabled
+    if app.config.get("ROLLUPS", {}).get("enabled", False):
+        celery_app.conf.beat_schedule = dict(celery_app.conf.beat_schedule or {})
+        celery_app.conf.beat_schedule["maintain-rollups"] = {
+            "task": "app.tasks.maintain_rollups_task",
+            "schedule": app.config["ROLLUPS"].get("interval", 60)
+        }
+
+    # Serve the metrics of the worker processes (aggregated with PROMETHEUS_MULTIPROC_DIR) if a port is set
+    worker_metrics_port = app.config.get("WORKER_METRICS_PORT")
+    if worker_metrics_port:
+        worker_init.connect(lambda **kwargs: start_metrics_server(int(worker_metrics_port)), weak=False)
+
     celery_app.set_default()
     app.extensions["celery"] = celery_app
     return celery_app
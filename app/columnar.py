@@ -0,0 +1,205 @@
+import logging
+
+import numpy as np
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The resolution of the stored timestamps
+TIMESTAMP_UNIT = "us"
+
+
+# Parse an array of Signal K (ISO 8601, UTC) timestamps at once
+def parse_timestamps(timestamps):
+    # NumPy parses naive ISO 8601 strings only: drop the UTC designator
+    return np.array([timestamp.rstrip("Z") for timestamp in timestamps], dtype="datetime64[" + TIMESTAMP_UNIT + "]")
+
+
+# Get the values as a float64 array, None if they are not all numbers
+def numeric_column(values):
+    # Check if the values are numbers (JSON booleans are not)
+    for value in values:
+        if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+
+    return np.array(values, dtype=np.float64)
+
+
+class ColumnBatch:
+    """
+    The rows of a Signal K path stored as columns: context, timestamp, source and value.
+    The timestamps are a datetime64 array, the numeric values are also available as a float64 array;
+    the positions also have the longitude and latitude arrays.
+    """
+
+    def __init__(self, path, contexts, timestamps, sources, values):
+        self.path = path
+        self.contexts = contexts
+        self.timestamps = parse_timestamps(timestamps)
+        self.sources = sources
+        self.values = values
+        self.numeric = numeric_column(values)
+
+        # Check if the path is related to a position
+        if path == "navigation.position":
+            self.lon = np.array([value["longitude"] for value in values], dtype=np.float64)
+            self.lat = np.array([value["latitude"] for value in values], dtype=np.float64)
+        else:
+            self.lon = None
+            self.lat = None
+
+    def __len__(self):
+        return len(self.values)
+
+    # Get the timestamps as datetime objects
+    def datetimes(self):
+        return self.timestamps.tolist()
+
+    # Get the timestamps as ISO 8601 strings
+    def isoformats(self):
+        return np.datetime_as_string(self.timestamps, unit=TIMESTAMP_UNIT).tolist()
+
+    # Get the rows as dictionaries, as expected by the SQLAlchemy executemany
+    def rows(self):
+        # Get the timestamps at once
+        datetimes = self.datetimes()
+
+        # Check if the path is related to a position
+        if self.lon is not None:
+
+            # Add the coordinates (the point is computed by the database)
+            return [
+                {
+                    "context": context, "timestamp": timestamp, "source": source, "value": value,
+                    "lon": lon, "lat": lat
+                }
+                for context, timestamp, source, value, lon, lat in zip(
+                    self.contexts, datetimes, self.sources, self.values, self.lon.tolist(), self.lat.tolist()
+                )
+            ]
+
+        return [
+            {"context": context, "timestamp": timestamp, "source": source, "value": value}
+            for context, timestamp, source, value in zip(self.contexts, datetimes, self.sources, self.values)
+        ]
+
+
+class ColumnarParser:
+    """
+    Turns the update items of a parcel into per-path column batches.
+    The values are appended to per-path column lists; a batch is built (parsing its timestamps at once)
+    when a path reaches the batch size and when the parcel is over.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+        # The columns waiting to become a batch, by path: contexts, timestamps, sources, values
+        self.columns = {}
+
+        # The source rows, once per context and label
+        self.sources = []
+        self.known_sources = set()
+
+    # Add an update item and get the batches filled by it
+    def feed(self, update_item):
+        # The batches filled by the update item
+        batches = []
+
+        # Skip this update item if context is not in it
+        if "context" not in update_item:
+
+            # Log a error message
+            log.error("Context not present in the update item")
+            return batches
+
+        # Get the context
+        context = update_item["context"]
+
+        # Skip this update item if updates is not in it
+        if "updates" not in update_item:
+
+            # Log a error message
+            log.error("The updates array is not present in the update item")
+            return batches
+
+        # For each update in the updates array
+        for update in update_item["updates"]:
+
+            # Check if the mandatory timestamp for the update is set
+            if "timestamp" not in update:
+
+                # Log a error message
+                log.error("The timestamp is not present in the update")
+                continue
+
+            # Get the timestamp (parsed later, once for the whole batch)
+            timestamp = update["timestamp"]
+
+            # Get the source reference
+            source = None
+            source_ref = update.get("$source")
+
+            # Check if the source full description is present
+            if source_ref is None and "source" in update:
+
+                # Get the source full description
+                source = update["source"]
+
+                # Get the source reference
+                source_ref = source.get("label")
+
+            # Check if the source must be added to the sources table
+            if source is not None and (context, source_ref) not in self.known_sources:
+
+                # Remember the source, so it is queued once per parcel
+                self.known_sources.add((context, source_ref))
+
+                # Queue the source row
+                self.sources.append({
+                    "context": context,
+                    "label": source_ref,
+                    "type": source.get("type", ""),
+                    "value": source
+                })
+
+            # Check if the update has a list of values
+            if "values" not in update:
+
+                # Log an error message
+                log.error("values not in the update")
+                continue
+
+            # For each value in the list of values
+            for value in update["values"]:
+
+                # Check if the path is present
+                if "path" not in value:
+                    continue
+
+                # Get the columns of the path
+                path = value["path"]
+                columns = self.columns.get(path)
+                if columns is None:
+                    columns = self.columns[path] = ([], [], [], [])
+
+                # Append the row
+                columns[0].append(context)
+                columns[1].append(timestamp)
+                columns[2].append(source_ref)
+                columns[3].append(value["value"])
+
+                # Check if the batch is full
+                if len(columns[3]) >= self.batch_size:
+                    batches.append(self._batch(path))
+
+        return batches
+
+    # Get the batches of the columns still waiting
+    def drain(self):
+        return [self._batch(path) for path in list(self.columns)]
+
+    # Build the batch of a path and start new columns
+    def _batch(self, path):
+        contexts, timestamps, sources, values = self.columns.pop(path)
+        return ColumnBatch(path, contexts, timestamps, sources, values)
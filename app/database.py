@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+
+import redis
+from sqlalchemy import create_engine, event
+
+from app.metrics import DB_POOL_WAIT_SECONDS, DB_POOL_CHECKOUT_SECONDS, DB_POOL_CHECKED_OUT, DB_POOL_CONNECTIONS
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The process-wide engines, one for each connection string
+_engines = {}
+
+# Protect the engines dictionary
+_engines_lock = threading.Lock()
+
+# The process-wide Redis clients, one for each URL
+_redis_clients = {}
+
+
+# Get the engine options (pool size, overflow, recycle, pre ping) from the application configuration
+def engine_options_from_config(config):
+    return dict(config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+
+
+# Attach the pool metrics to a newly created engine
+def _instrument(engine):
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Count the new connection
+        DB_POOL_CONNECTIONS.inc()
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        # Remember when the connection has been checked out
+        connection_record.info["checkout_time"] = time.perf_counter()
+
+        # Update the checked out connections
+        DB_POOL_CHECKED_OUT.inc()
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        # Get when the connection has been checked out
+        checkout_time = connection_record.info.pop("checkout_time", None)
+
+        # Check if the connection has been checked out by this process
+        if checkout_time is not None:
+
+            # Observe how long the connection has been used
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - checkout_time)
+
+            # Update the checked out connections
+            DB_POOL_CHECKED_OUT.dec()
+
+
+# The pysqlite driver doesn't begin a transaction before a SAVEPOINT, so the savepoint starts one and releasing it
+# commits (the rows of a parcel would be durable even if the parcel is then rolled back): disable the transaction
+# handling of the driver and emit BEGIN when SQLAlchemy begins a transaction (the recipe of the SQLAlchemy docs)
+def _fix_sqlite_transactions(engine):
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Disable the BEGIN emitted by pysqlite
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def on_begin(conn):
+        # Emit our own BEGIN
+        conn.exec_driver_sql("BEGIN")
+
+
+# Get the process-wide engine for the connection string, creating it at the first use
+def get_engine(connection_string, engine_options=None):
+    # Get the engine, if already created
+    engine = _engines.get(connection_string)
+
+    # Check if the engine must be created
+    if engine is None:
+        with _engines_lock:
+
+            # Check again, another thread could have created the engine in the meanwhile
+            engine = _engines.get(connection_string)
+
+            if engine is None:
+                # Create the engine with its connection pool
+                engine = create_engine(connection_string, echo=False, **(engine_options or {}))
+
+                # Collect the pool metrics
+                _instrument(engine)
+
+                # Let SQLAlchemy control the SQLite transactions
+                if engine.dialect.name == "sqlite":
+                    _fix_sqlite_transactions(engine)
+
+                # Store the engine
+                _engines[connection_string] = engine
+
+                # Log a debug message
+                log.debug("Created engine for pid %s: %s", os.getpid(), engine.pool.status())
+
+    return engine
+
+
+# Get a connection from the engine pool, measuring the time spent waiting for it
+def connect(engine):
+    # Get the current time
+    start = time.perf_counter()
+
+    # Check out a connection
+    conn = engine.connect()
+
+    # Observe the time spent waiting
+    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    return conn
+
+
+# Get the Redis URL from the application configuration (the Celery broker by default)
+def redis_url_from_config(config):
+    return config.get("REDIS_URL") or config["CELERY"]["broker_url"]
+
+
+# Get the process-wide Redis client for the URL (its connection pool is fork safe)
+def get_redis(url):
+    # Get the client, if already created
+    client = _redis_clients.get(url)
+
+    # Check if the client must be created
+    if client is None:
+        client = _redis_clients.setdefault(url, redis.Redis.from_url(url))
+
+    return client
+
+
+# Make the engines usable in a child process after fork() (i.e. the Celery prefork pool)
+def _after_fork_in_child():
+    # For each engine inherited from the parent process
+    for engine in _engines.values():
+
+        # Drop the pooled connections without closing the sockets shared with the parent
+        engine.dispose(close=False)
+
+
+# Register the after fork handler
+os.register_at_fork(after_in_child=_after_fork_in_child)
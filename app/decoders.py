@@ -0,0 +1,83 @@
+import json
+import logging
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The decoders tried by "auto", fastest first
+AUTO_DECODERS = ("orjson", "simdjson", "json")
+
+# The decoders already resolved, by name
+_decoders = {}
+
+
+# Build the orjson decoder
+def _orjson():
+    import orjson
+    return orjson.loads
+
+
+# Build the simdjson decoder (pysimdjson)
+def _simdjson():
+    import simdjson
+    return simdjson.loads
+
+
+# Build the standard library decoder
+def _json():
+    return json.loads
+
+
+# The decoder builders, by name
+BUILDERS = {
+    "orjson": _orjson,
+    "simdjson": _simdjson,
+    "json": _json
+}
+
+
+# Wrap a fast decoder falling back to the standard library one on the documents it rejects
+# (i.e. NaN, Infinity or integers beyond 64 bits, accepted by json.loads)
+def _with_fallback(loads):
+    def decode(data):
+        try:
+            return loads(data)
+        except ValueError:
+            return json.loads(data)
+
+    return decode
+
+
+# Get the function decoding a JSON document from bytes (no UTF-8 decoding to str is needed)
+def get_decoder(name="auto"):
+    # Check if the decoder has been already resolved
+    decoder = _decoders.get(name)
+    if decoder is not None:
+        return decoder
+
+    # Get the candidate decoders
+    names = AUTO_DECODERS if name == "auto" else (name,)
+
+    # Check if the decoder is known
+    if any(candidate not in BUILDERS for candidate in names):
+        raise ValueError("Unknown JSON decoder " + name)
+
+    for candidate in names:
+        try:
+            loads = BUILDERS[candidate]()
+        except ImportError:
+            # Log a debug message
+            log.debug("JSON decoder %s not available", candidate)
+            continue
+
+        # Log a debug message
+        log.debug("Using the %s JSON decoder", candidate)
+
+        decoder = loads if candidate == "json" else _with_fallback(loads)
+        break
+
+    else:
+        raise ValueError("JSON decoder " + name + " not available")
+
+    _decoders[name] = decoder
+    return decoder
@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+import zlib
+
+from app.tracks import iter_gpx, format_time, DEFAULT_YIELD_PER
+
+# Optional dependencies: Apache Parquet export and Brotli compression
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Stream a GeoJSON Feature with the track as LineString
+def iter_geojson(points, context, chunk_size=DEFAULT_YIELD_PER):
+    yield '{"type": "Feature", "properties": {"context": ' + json.dumps(context) + '}, ' \
+          '"geometry": {"type": "LineString", "coordinates": ['
+
+    separator = ""
+    chunk = []
+    for lon, lat, timestamp, source in points:
+        chunk.append(separator + "[" + str(lon) + ", " + str(lat) + "]")
+        separator = ", "
+
+        # Check if the chunk is full
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield "".join(chunk)
+
+    yield ']}}\n'
+
+
+# Stream a CSV document with a header line
+def iter_csv(points, chunk_size=DEFAULT_YIELD_PER):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    writer.writerow(["timestamp", "lon", "lat", "source"])
+
+    for lon, lat, timestamp, source in points:
+        writer.writerow([format_time(timestamp), lon, lat, source])
+
+        # Check if the chunk is full
+        if buffer.tell() >= chunk_size * 64:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+# Stream an Apache Parquet file, one row group for each chunk of points
+def iter_parquet(points, chunk_size=DEFAULT_YIELD_PER * 64):
+    # The columns, the source is dictionary-encoded (a vessel has a handful of sources)
+    schema = pa.schema([
+        ("timestamp", pa.timestamp("us")),
+        ("lon", pa.float64()),
+        ("lat", pa.float64()),
+        ("source", pa.dictionary(pa.int32(), pa.string()))
+    ])
+
+    # The file is written in memory and given to the client as soon as each row group is complete
+    buffer = io.BytesIO()
+    writer = pq.ParquetWriter(buffer, schema, compression="snappy")
+
+    def write(columns):
+        writer.write_table(pa.table([
+            pa.array(columns[0], pa.timestamp("us")),
+            pa.array(columns[1], pa.float64()),
+            pa.array(columns[2], pa.float64()),
+            pa.array(columns[3], pa.string()).dictionary_encode()
+        ], schema=schema))
+
+    try:
+        columns = ([], [], [], [])
+        for lon, lat, timestamp, source in points:
+            columns[0].append(timestamp)
+            columns[1].append(lon)
+            columns[2].append(lat)
+            columns[3].append(source)
+
+            # Check if the row group is full
+            if len(columns[0]) >= chunk_size:
+                write(columns)
+                columns = ([], [], [], [])
+
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        if columns[0]:
+            write(columns)
+
+    finally:
+        # Write the footer
+        writer.close()
+
+    yield buffer.getvalue()
+
+
+# The export formats: generator factory (points, context), mimetype, file extension, compressible
+FORMATS = {
+    "gpx": (lambda points, context: iter_gpx(points), "application/gpx+xml", "gpx", True),
+    "geojson": (iter_geojson, "application/geo+json", "geojson", True),
+    "csv": (lambda points, context: iter_csv(points), "text/csv", "csv", True),
+    "parquet": (lambda points, context: iter_parquet(points), "application/vnd.apache.parquet", "parquet", False)
+}
+
+
+# Get the export formats available (Apache Parquet requires pyarrow)
+def available_formats():
+    return [name for name in FORMATS if name != "parquet" or pa is not None]
+
+
+# Get the content encodings available, the preferred first
+def available_encodings():
+    return (["br"] if brotli is not None else []) + ["gzip"]
+
+
+# Compress a stream of chunks (str or bytes) with a content encoding (br or gzip)
+def iter_compressed(chunks, encoding):
+    # Get the compressor
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        compress, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, flush = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        # Encode the text chunks
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+
+        data = compress(chunk)
+        if data:
+            yield data
+
+    yield flush()
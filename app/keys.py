@@ -0,0 +1,72 @@
+import os
+import threading
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from app.metrics import KEY_CACHE_REQUESTS
+
+
+class KeyCache:
+    """
+    In-process cache of the parsed RSA keys, keyed by file path.
+    An entry is valid while the key file keeps the same mtime, size and inode, so a key replaced
+    on disk (even by another process) is parsed again at the next lookup.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Get the object built from the key file, parsing the file only if it changed
+    def get(self, kind, path, build):
+        # Get the key file status
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+        # Check if the cached object is still valid
+        entry = self.entries.get((kind, path))
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            KEY_CACHE_REQUESTS.labels(kind, "hit").inc()
+            return entry[1]
+
+        self.misses += 1
+        KEY_CACHE_REQUESTS.labels(kind, "miss").inc()
+
+        # Parse the key
+        with open(path, "rb") as f:
+            value = build(RSA.importKey(f.read()))
+
+        with self.lock:
+            self.entries[(kind, path)] = (version, value)
+
+        return value
+
+    # Get the PKCS1_OAEP cipher for a private key file
+    def decryptor(self, private_key_filename):
+        return self.get("private", private_key_filename, PKCS1_OAEP.new)
+
+    # Get the PKCS1_v1_5 signature verifier for a public key file
+    def verifier(self, public_key_filename):
+        return self.get("public", public_key_filename, PKCS1_v1_5.new)
+
+    # Drop the cached objects for a key file, or all of them
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if key[1] == path]:
+                    del self.entries[key]
+
+    # Get the hit/miss counters
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+# The process-wide key cache
+key_cache = KeyCache()
@@ -0,0 +1,118 @@
+import logging
+
+import numpy as np
+from sqlalchemy import select, and_, func, literal, JSON
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.schema import insert_ignore
+
+# Create the logger
+log = logging.getLogger('app')
+
+
+# Get the latest row of each context in a column batch
+def latest_rows(batch):
+    # Get the contexts at once
+    contexts = np.array(batch.contexts, dtype=object)
+
+    rows = []
+
+    # For each context in the batch (usually one: a parcel comes from one vessel)
+    for context in np.unique(contexts):
+
+        # Get the position of the newest timestamp of the context
+        positions = np.flatnonzero(contexts == context)
+        index = positions[batch.timestamps[positions].argmax()]
+
+        rows.append({
+            "context": context,
+            "path": batch.path,
+            "timestamp": batch.timestamps[index].item(),
+            "source": batch.sources[index],
+            "value": batch.values[index]
+        })
+
+    return rows
+
+
+# Merge the latest rows, keeping the newest one for each context and path
+def merge_latest(latest, rows):
+    for row in rows:
+        key = (row["context"], row["path"])
+        current = latest.get(key)
+        if current is None or current["timestamp"] < row["timestamp"]:
+            latest[key] = row
+
+
+# Upsert the latest values, replacing the stored ones only if they are older
+def upsert_latest(conn, table, rows):
+    # Nothing to do if there are no rows
+    if not rows:
+        return 0
+
+    # Check if the dialect supports ON CONFLICT DO UPDATE
+    if conn.dialect.name == "postgresql":
+        statement = postgresql.insert(table)
+    elif conn.dialect.name == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        log.warning("Latest values not supported by %s", conn.dialect.name)
+        return 0
+
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.context, table.c.path],
+        set_={
+            "timestamp": statement.excluded.timestamp,
+            "source": statement.excluded.source,
+            "value": statement.excluded.value
+        },
+        where=table.c.timestamp < statement.excluded.timestamp
+    )
+
+    # Sort the rows by key, so concurrent parcels lock them in the same order
+    conn.execute(statement, sorted(rows, key=lambda row: (row["context"], row["path"])))
+
+    return len(rows)
+
+
+# Fill the latest values of a path from its table (i.e. the data stored before the latest values were maintained)
+def backfill_latest(conn, table, data_table, path):
+    newer = data_table.alias("newer")
+
+    # Get the value as JSON (the path tables store numbers and strings in typed columns)
+    value = data_table.c.value
+    if not isinstance(value.type, JSON):
+        value = func.to_json(value) if conn.dialect.name == "postgresql" else func.json_quote(value)
+
+    # Select the rows having the newest timestamp of their context
+    rows = select(
+        data_table.c.context, literal(path), data_table.c.timestamp, data_table.c.source, value
+    ).where(
+        data_table.c.timestamp == select(func.max(newer.c.timestamp)).where(
+            newer.c.context == data_table.c.context
+        ).scalar_subquery()
+    )
+
+    # Insert the rows, keeping the values already maintained at ingest time
+    result = conn.execute(insert_ignore(conn, table).from_select(
+        ["context", "path", "timestamp", "source", "value"], rows
+    ))
+
+    return result.rowcount
+
+
+# Select the last position of each vessel, with the vessel information
+def select_last_positions(table):
+    info = table.alias("info")
+    position = table.alias("position")
+
+    return select(position.c.context, position.c.timestamp, info.c.value, position.c.value).join(
+        info, and_(info.c.context == position.c.context, info.c.path == "")
+    ).where(position.c.path == "navigation.position").order_by(position.c.context)
+
+
+# Select the latest value of each path of a vessel
+def select_latest(table, context):
+    return select(table.c.path, table.c.timestamp, table.c.source, table.c.value).where(
+        table.c.context == context
+    ).order_by(table.c.path)
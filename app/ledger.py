@@ -0,0 +1,63 @@
+import datetime
+import logging
+
+from sqlalchemy import update
+
+from app.database import connect
+from app.schema import get_registry, insert_ignore
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The parcel has been received and enqueued
+RECEIVED = "received"
+
+# The parcel has been stored
+PROCESSED = "processed"
+
+# The parcel processing failed, a new upload of the same parcel is accepted
+FAILED = "failed"
+
+
+# Record a received parcel in the ledger, return False if the same parcel has been already received
+def register_parcel(engine, context, file_name, sha256, size):
+    # Get the ledger table
+    parcels_table = get_registry(engine).parcels_table()
+
+    with connect(engine) as conn, conn.begin():
+
+        # Add the parcel, unless its hash is already in the ledger
+        result = conn.execute(insert_ignore(conn, parcels_table).values(
+            sha256=sha256,
+            context=context,
+            file_name=file_name,
+            size=size,
+            status=RECEIVED,
+            received=datetime.datetime.utcnow()
+        ))
+
+        # Check if the parcel is new
+        if result.rowcount == 1:
+            return True
+
+        # Accept the parcel again only if its previous processing failed
+        result = conn.execute(
+            update(parcels_table)
+            .where(parcels_table.c.sha256 == sha256, parcels_table.c.status == FAILED)
+            .values(file_name=file_name, status=RECEIVED, received=datetime.datetime.utcnow(), processed=None)
+        )
+
+        return result.rowcount == 1
+
+
+# Update the status of a parcel in the ledger
+def mark_parcel(engine, sha256, status):
+    # Get the ledger table
+    parcels_table = get_registry(engine).parcels_table()
+
+    with connect(engine) as conn, conn.begin():
+        conn.execute(
+            update(parcels_table)
+            .where(parcels_table.c.sha256 == sha256)
+            .values(status=status, processed=datetime.datetime.utcnow())
+        )
@@ -0,0 +1,125 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# The default format of the log lines
+DEFAULT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+# The default fraction of the sampled records let through
+DEFAULT_SAMPLE_RATE = 0.01
+
+# The extra argument of the records to be sampled (i.e. the per-row events): log.debug(..., extra=SAMPLED)
+SAMPLED = {"sampled": True}
+
+# The handler installed on the root logger, and the listener writing the queued records (if any)
+_handler = None
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only a fraction of the records logged with the SAMPLED extra argument, so the per-row
+    events don't flood the output (and the I/O) when a whole batch is failing; the other records pass.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the records as JSON lines, ready to be shipped to a log collector.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage()
+        }
+
+        # Add the exception, if any (the queued records have it already in the message)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+# Start the listener writing the queued records with the output handler
+def _start_listener(output):
+    global _listener
+
+    _handler.queue = queue.SimpleQueue()
+    _listener = QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+# Stop the listener, writing the records still queued
+def stop_listener():
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# The listener thread doesn't survive a fork (i.e. the Celery prefork workers): start a new one in the child
+def _after_fork():
+    if _listener is not None:
+        _start_listener(_listener.handlers[0])
+
+
+# Configure the logging of the process from the LOGGING settings of the application configuration:
+# level, format, json (JSON lines), queue (write from a background thread, the default with json),
+# sample_rate (fraction of the sampled records let through) and loggers (level by logger name)
+def configure_logging(config):
+    global _handler
+
+    settings = config.get("LOGGING", {})
+
+    # Create the output handler
+    output = logging.StreamHandler()
+    if settings.get("json", False):
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(settings.get("format", DEFAULT_FORMAT)))
+
+    root = logging.getLogger()
+
+    # Remove the handler of a previous configuration
+    stop_listener()
+    if _handler is not None:
+        root.removeHandler(_handler)
+
+    # Check if the records must be written by a background thread, so the I/O is off the logging thread
+    if settings.get("queue", settings.get("json", False)):
+        _handler = QueueHandler(queue.SimpleQueue())
+        _start_listener(output)
+    else:
+        _handler = output
+
+    # Drop the sampled records before they are formatted
+    _handler.addFilter(SamplingFilter(settings.get("sample_rate", DEFAULT_SAMPLE_RATE)))
+
+    root.addHandler(_handler)
+    root.setLevel(settings.get("level", "INFO"))
+
+    # Set the level of some loggers (i.e. "sqlalchemy.engine": "INFO" to log the statements)
+    for name, level in settings.get("loggers", {}).items():
+        logging.getLogger(name).setLevel(level)
+
+
+# Write the queued records at exit, and restart the listener in the forked processes
+atexit.register(stop_listener)
+os.register_at_fork(after_in_child=_after_fork)
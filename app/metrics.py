@@ -0,0 +1,225 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, multiprocess, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+
+# Time spent waiting for a connection from the database pool
+DB_POOL_WAIT_SECONDS = Histogram(
+    "dynamo_db_pool_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+
+# Time a connection stays checked out from the database pool
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "dynamo_db_pool_checkout_seconds",
+    "Time a connection stays checked out from the database pool"
+)
+
+# Connections currently checked out from the database pool
+DB_POOL_CHECKED_OUT = Gauge(
+    "dynamo_db_pool_checked_out",
+    "Connections currently checked out from the database pool",
+    multiprocess_mode="livesum"
+)
+
+# New connections opened by the database pool
+DB_POOL_CONNECTIONS = Counter(
+    "dynamo_db_pool_connections",
+    "New connections opened by the database pool"
+)
+
+
+# Lookups of the parsed RSA keys cache
+KEY_CACHE_REQUESTS = Counter(
+    "dynamo_key_cache_requests",
+    "Lookups of the parsed RSA keys cache",
+    ["kind", "result"]
+)
+
+
+# Time spent in each stage of the parcel processing (key_header, rsa_unwrap, aes_decrypt, gunzip, verify, parse,
+# db_write), for each parcel
+PARCEL_STAGE_SECONDS = Histogram(
+    "dynamo_parcel_stage_seconds",
+    "Time spent in each stage of the parcel processing",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0)
+)
+
+# Size of the processed parcels
+PARCEL_BYTES = Histogram(
+    "dynamo_parcel_bytes",
+    "Size of the processed parcels",
+    buckets=(1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+)
+
+# Rows stored for each parcel
+PARCEL_ROWS = Histogram(
+    "dynamo_parcel_rows",
+    "Rows stored for each parcel",
+    buckets=(10, 100, 1000, 10000, 100000, 1000000)
+)
+
+# Processed parcels, by status (processed or failed)
+PARCELS = Counter(
+    "dynamo_parcels",
+    "Processed parcels",
+    ["status"]
+)
+
+# Failed database writes, by table and operation
+DB_ERRORS = Counter(
+    "dynamo_db_errors",
+    "Failed database writes",
+    ["table", "operation"]
+)
+
+
+class StageTimer:
+    """
+    Measures the time spent in the stages of a streamed pipeline (i.e. decrypt, gunzip and parse a parcel while it
+    is stored). The stages run nested in each other: the time of a stage doesn't include the nested ones.
+    """
+
+    def __init__(self):
+        # The total time of each stage
+        self.totals = {}
+
+        # The time spent in the nested stages, for each running stage
+        self.nested = []
+
+    # Measure a stage
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        self.nested.append(0.0)
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = self.nested.pop()
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed - nested
+
+            # Check if the stage runs inside another one
+            if self.nested:
+                self.nested[-1] = self.nested[-1] + elapsed
+
+    # Measure the time spent producing the items of an iterable
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+
+        try:
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+
+                yield item
+        finally:
+            # Close the wrapped generator as soon as the pipeline is closed
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    # Record the total time of each stage
+    def observe(self, histogram=PARCEL_STAGE_SECONDS):
+        for name, total in self.totals.items():
+            histogram.labels(name).observe(total)
+
+
+class IngestCollector:
+    """
+    Collects, when scraped, the ingestion backlog: the messages waiting in the Celery queues (Redis lists)
+    and the parcels waiting in the media root, by vessel.
+    """
+
+    def __init__(self, client, queues, media_root, is_parcel):
+        self.client = client
+        self.queues = queues
+        self.media_root = media_root
+        self.is_parcel = is_parcel
+
+    def collect(self):
+        depth = GaugeMetricFamily("dynamo_queue_depth", "Messages waiting in the Celery queues", labels=["queue"])
+
+        # Get the lengths of the queues with one round trip
+        pipeline = self.client.pipeline(transaction=False)
+        for queue in self.queues:
+            pipeline.llen(queue)
+
+        try:
+            lengths = pipeline.execute()
+        except Exception:
+            # The broker is not reachable, the queues are not reported
+            lengths = []
+
+        for queue, length in zip(self.queues, lengths):
+            depth.add_metric([queue], length)
+
+        yield depth
+
+        backlog_bytes = GaugeMetricFamily("dynamo_backlog_bytes", "Size of the parcels waiting in the media root",
+                                          labels=["vessel"])
+        backlog_parcels = GaugeMetricFamily("dynamo_backlog_parcels", "Parcels waiting in the media root",
+                                            labels=["vessel"])
+
+        # For each vessel directory in the media root
+        if os.path.isdir(self.media_root):
+            with os.scandir(self.media_root) as directories:
+                for directory in directories:
+                    if not directory.is_dir():
+                        continue
+
+                    # Sum the sizes of the parcels
+                    sizes = []
+                    with os.scandir(directory.path) as entries:
+                        for entry in entries:
+                            if entry.is_file() and self.is_parcel(entry.name):
+                                sizes.append(entry.stat().st_size)
+
+                    backlog_bytes.add_metric([directory.name], sum(sizes))
+                    backlog_parcels.add_metric([directory.name], len(sizes))
+
+        yield backlog_bytes
+        yield backlog_parcels
+
+
+# Get the registry of the metrics to be exposed
+def metrics_registry():
+    # Check if the metrics are collected by several processes (Celery prefork workers, gunicorn, ...)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+
+        # Aggregate the metrics written by each process
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+        return registry
+
+    # Use the metrics of this process
+    return REGISTRY
+
+
+# Render the metrics in the Prometheus text format, with the metrics of some collectors computed now
+def generate_metrics(collectors=()):
+    data = generate_latest(metrics_registry())
+
+    # Check if there are collectors computed at scrape time
+    if collectors:
+        registry = CollectorRegistry()
+        for collector in collectors:
+            registry.register(collector)
+
+        data = data + generate_latest(registry)
+
+    return data, CONTENT_TYPE_LATEST
+
+
+# Serve the metrics of the Celery worker processes over HTTP
+def start_metrics_server(port, address="0.0.0.0"):
+    start_http_server(port, address, registry=metrics_registry())
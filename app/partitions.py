@@ -0,0 +1,267 @@
+import datetime
+import logging
+import re
+import threading
+
+import numpy as np
+from sqlalchemy import text
+
+from app.database import connect
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The partition intervals: NumPy datetime unit and partition name suffix format
+INTERVALS = {
+    "month": ("M", "%Y%m"),
+    "day": ("D", "%Y%m%d")
+}
+
+# The process-wide partition managers, one for each engine
+_managers = {}
+
+# Protect the managers dictionary
+_managers_lock = threading.Lock()
+
+# The bounds of a range partition, as returned by pg_get_expr
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+# Get the partition clause of the path tables, None if the partitioning is disabled
+def partition_by(partitioning):
+    # Check if the path tables must be partitioned
+    if partitioning and partitioning.get("enabled", False):
+        return "RANGE (timestamp)"
+
+    return None
+
+
+class PartitionManager:
+    """
+    Maintains the range partitions of the path tables partitioned by timestamp.
+    The ingestion never issues DDL on a partitioned table: the rows of an interval without a partition are stored
+    in the default partition, and the maintenance task (in short transactions of its own, giving up on a lock
+    it can't get soon) creates the partitions ahead of time and moves those rows to the partitions of their interval.
+    """
+
+    def __init__(self, engine, partitioning):
+        self.engine = engine
+        self.interval = partitioning.get("interval", "month")
+        self.unit, self.suffix_format = INTERVALS[self.interval]
+        self.premake = partitioning.get("premake", 3)
+        self.retention = partitioning.get("retention")
+        self.retention_action = partitioning.get("retention_action", "detach")
+        self.lock_timeout = partitioning.get("lock_timeout", 5)
+        self.lock = threading.Lock()
+
+        # The partitioned tables, None until loaded
+        self.partitioned = None
+
+    # Load the names of the partitioned tables
+    def load(self, conn):
+        result = conn.execute(text(
+            "SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relnamespace = 'public'::regnamespace"
+        ))
+
+        with self.lock:
+            self.partitioned = set(row[0] for row in result)
+
+    # Get the partition name of an interval start
+    def partition_name(self, table_name, start):
+        return table_name + "_p" + start.astype(datetime.datetime).strftime(self.suffix_format)
+
+    # Get a name not taken by another table, adding a counter if needed (i.e. the name of a detached partition)
+    def free_name(self, conn, name):
+        taken = set(row[0] for row in conn.execute(text(
+            "SELECT relname FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname LIKE :prefix"
+        ), {"prefix": name + "%"}))
+
+        candidate = name
+        counter = 0
+        while candidate in taken:
+            counter = counter + 1
+            candidate = name + "_" + str(counter)
+
+        return candidate
+
+    # Create the partition of an interval, which must not be attached yet
+    def create(self, conn, table_name, start):
+        # Get a partition name (a partition detached by the retention keeps its name) and the bounds
+        name = self.free_name(conn, self.partition_name(table_name, start))
+        end = start + 1
+
+        # Create the partition
+        conn.execute(text(
+            'CREATE TABLE "' + name + '" PARTITION OF "' + table_name + '" ' +
+            "FOR VALUES FROM ('" + str(start.astype("datetime64[D]")) + "') " +
+            "TO ('" + str(end.astype("datetime64[D]")) + "')"
+        ))
+
+        # Log a debug message
+        log.debug("Partition %s created", name)
+
+        return name
+
+    # Get the partitions attached to a table (from pg_inherits, not by name), as (name, start, end);
+    # the default partition has no bounds
+    def partitions(self, conn, table_name):
+        result = conn.execute(text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table_name AS regclass)"
+        ), {"table_name": '"' + table_name + '"'})
+
+        partitions = []
+        for name, bound in result:
+            # Parse the bounds
+            match = BOUND_PATTERN.search(bound or "")
+            if match is not None:
+                partitions.append((
+                    name,
+                    np.datetime64(match.group(1)[:10], "D"),
+                    np.datetime64(match.group(2)[:10], "D")
+                ))
+
+            # Check if the partition is the default one
+            elif bound == "DEFAULT":
+                partitions.append((name, None, None))
+
+        return partitions
+
+    # Get the interval starts having an attached partition
+    def attached(self, conn, table_name):
+        return set(start for name, start, end in self.partitions(conn, table_name) if start is not None)
+
+    # Move the rows of the default partition to the partitions of their intervals, creating them;
+    # returns the number of rows moved
+    def move_stray_rows(self, conn, table_name, default):
+        # Get the intervals of the rows in the default partition
+        starts = [
+            np.datetime64(row[0], self.unit) for row in conn.execute(text(
+                "SELECT DISTINCT date_trunc('" + self.interval + "', timestamp) FROM \"" + default + '"'
+            ))
+        ]
+
+        # Check if there are rows to be moved
+        if not starts:
+            return 0
+
+        # Get the columns to be copied (the generated ones are computed again)
+        columns = [row[0] for row in conn.execute(text(
+            "SELECT attname FROM pg_attribute WHERE attrelid = CAST(:table_name AS regclass) AND attnum > 0 "
+            "AND NOT attisdropped AND attgenerated = '' ORDER BY attnum"
+        ), {"table_name": '"' + table_name + '"'})]
+        column_list = ", ".join('"' + column + '"' for column in columns)
+
+        # Detach the default partition: a partition can't be created while the default one has rows of its interval
+        conn.execute(text('ALTER TABLE "' + table_name + '" DETACH PARTITION "' + default + '"'))
+
+        # Create the partitions of the rows
+        for start in starts:
+            self.create(conn, table_name, start)
+
+        # Move the rows, routed to their partitions by the parent table
+        moved = conn.execute(text(
+            'INSERT INTO "' + table_name + '" (' + column_list + ') SELECT ' + column_list + ' FROM "' + default + '"'
+        )).rowcount
+        conn.execute(text('TRUNCATE "' + default + '"'))
+
+        # Attach the default partition again
+        conn.execute(text('ALTER TABLE "' + table_name + '" ATTACH PARTITION "' + default + '" DEFAULT'))
+
+        # Log an info message
+        log.info("%s rows of %s moved out of the default partition", moved, table_name)
+
+        return moved
+
+    # Create the default partition and the partitions of the next intervals, move the rows out of the default
+    # partition and apply the retention policy to a table
+    def maintain(self, conn, table_name, now=None):
+        # Get the current interval start
+        if now is None:
+            now = datetime.datetime.utcnow()
+        current = np.datetime64(now, self.unit)
+
+        # Serialize the maintenance of the table among the workers
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": table_name + "_partitions"})
+
+        # Don't make the writers of the table queue behind a lock the maintenance waits for (the maintenance gives up,
+        # it is run again later)
+        conn.execute(text("SET LOCAL lock_timeout = '" + str(int(self.lock_timeout * 1000)) + "ms'"))
+
+        # Get the default partition, creating it for the tables partitioned before it was introduced
+        default = next((name for name, start, end in self.partitions(conn, table_name) if start is None), None)
+        if default is None:
+            default = self.free_name(conn, table_name + "_default")
+            conn.execute(text('CREATE TABLE "' + default + '" PARTITION OF "' + table_name + '" DEFAULT'))
+
+        # Move the rows stored while their partitions didn't exist
+        self.move_stray_rows(conn, table_name, default)
+
+        # Create the current and the next partitions
+        attached = self.attached(conn, table_name)
+        for ahead in range(self.premake + 1):
+            if (current + ahead).astype("datetime64[D]") not in attached:
+                self.create(conn, table_name, current + ahead)
+
+        # Check if a retention policy is set
+        removed = []
+        if self.retention is not None:
+
+            # The partitions ending before the cutoff are expired
+            cutoff = (current - self.retention).astype("datetime64[D]")
+
+            for name, start, end in self.partitions(conn, table_name):
+                if end is not None and end <= cutoff:
+
+                    # Check if the partition must be kept as a standalone table
+                    if self.retention_action == "detach":
+                        conn.execute(text('ALTER TABLE "' + table_name + '" DETACH PARTITION "' + name + '"'))
+                    else:
+                        conn.execute(text('DROP TABLE "' + name + '"'))
+
+                    removed.append(name)
+
+                    # Log an info message
+                    log.info("Partition %s removed (%s)", name, self.retention_action)
+
+        return removed
+
+    # Maintain all the partitioned tables, one transaction for each table
+    def maintain_all(self, now=None):
+        removed = []
+
+        with connect(self.engine) as conn:
+
+            # Get the partitioned tables
+            with conn.begin():
+                self.load(conn)
+
+            # For each partitioned table
+            for table_name in sorted(self.partitioned):
+                try:
+                    with conn.begin():
+                        removed.extend(self.maintain(conn, table_name, now))
+
+                except Exception as exception:
+                    # Log a warning message, the table is maintained at the next run
+                    log.warning("While maintaining the partitions of %s: %s", table_name, exception)
+
+        return removed
+
+
+# Get the process-wide partition manager for the engine, None if the partitioning is disabled or not supported
+def get_partition_manager(engine, partitioning):
+    # Check if the partitioning is enabled and supported
+    if partition_by(partitioning) is None or engine.dialect.name != "postgresql":
+        return None
+
+    # Get the manager, if already created
+    manager = _managers.get(engine.url)
+
+    # Check if the manager must be created
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.setdefault(engine.url, PartitionManager(engine, partitioning))
+
+    return manager
@@ -0,0 +1,406 @@
+import itertools
+import logging
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, insert, func, literal, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from app.database import connect
+from app.schema import insert_ignore
+from app.timeseries import is_numeric, EPOCH
+from app.tracks import bucket_expression, iter_rows, DEFAULT_YIELD_PER
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The rollup resolutions: table name suffix and seconds, the finest first
+RESOLUTIONS = (("1m", 60), ("1h", 3600), ("1d", 86400))
+
+# The number of pending days rolled up by a maintenance run
+DEFAULT_ROLLUP_BATCH = 100
+
+
+# Check if the rollups are enabled in the application configuration
+def rollups_enabled(config):
+    return bool(config.get("ROLLUPS", {}).get("enabled", False))
+
+
+# Get the coarsest rollup resolution (suffix, seconds) a time bucket (seconds) is made of, None if there is none
+def rollup_resolution(bucket):
+    fitting = [resolution for resolution in RESOLUTIONS if bucket % resolution[1] == 0]
+    return fitting[-1] if fitting else None
+
+
+# Round a time bucket (seconds) up to a multiple of the coarsest resolution not greater than it
+def align_bucket(bucket):
+    fitting = [seconds for suffix, seconds in RESOLUTIONS if seconds <= bucket]
+
+    # Check if the bucket is finer than all the resolutions
+    if not fitting:
+        return bucket
+
+    return math.ceil(bucket / fitting[-1]) * fitting[-1]
+
+
+# Round a timestamp to a multiple of a resolution (seconds) since the epoch, up or down
+def round_time(timestamp, seconds, up=False):
+    elapsed = (timestamp - EPOCH).total_seconds() / seconds
+    return EPOCH + timedelta(seconds=(math.ceil(elapsed) if up else math.floor(elapsed)) * seconds)
+
+
+# Get the days of a column batch, as (context, day) pairs
+def dirty_days(batch):
+    days = batch.timestamps.astype("datetime64[D]").astype("datetime64[us]").tolist()
+    return set(zip(batch.contexts, days))
+
+
+# Mark the days whose rollups must be computed again: (table name, context, day) triples
+def mark_dirty(conn, table, days, now=None):
+    # Nothing to do if there are no days
+    if not days:
+        return 0
+
+    if now is None:
+        now = datetime.utcnow()
+
+    # Check if the dialect supports ON CONFLICT DO UPDATE
+    if conn.dialect.name == "postgresql":
+        statement = postgresql.insert(table)
+    elif conn.dialect.name == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        log.warning("Rollups not supported by %s", conn.dialect.name)
+        return 0
+
+    # A day marked again is rolled up again, even if a maintenance run is reading it
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.table_name, table.c.context, table.c.day],
+        set_={"marked": statement.excluded.marked}
+    )
+
+    # Sort the rows by key, so concurrent parcels lock them in the same order
+    conn.execute(statement, [
+        {"table_name": table_name, "context": context, "day": day, "marked": now}
+        for table_name, context, day in sorted(days)
+    ])
+
+    return len(days)
+
+
+# Mark all the days stored in a path table (i.e. the data stored before its rollups were created)
+def mark_all(conn, table, data_table, now=None):
+    if now is None:
+        now = datetime.utcnow()
+
+    # Get the day of each row
+    if conn.dialect.name == "postgresql":
+        day = func.date_trunc("day", data_table.c.timestamp)
+    else:
+        # SQLite, formatted as the stored timestamps
+        day = func.strftime("%Y-%m-%d 00:00:00.000000", data_table.c.timestamp)
+
+    # The WHERE clause resolves the SQLite parsing ambiguity of INSERT ... SELECT ... ON CONFLICT
+    days = select(literal(data_table.name), data_table.c.context, day, literal(now)).distinct().where(true())
+
+    result = conn.execute(insert_ignore(conn, table).from_select(["table_name", "context", "day", "marked"], days))
+
+    return result.rowcount
+
+
+# Select the partial aggregates of the rows of a table in time buckets, oldest first: (bucket number, count, min, max,
+# sum, last, last timestamp). The buckets are made from the time column, aggregate() gets the columns of the rows and
+# returns the count, min, max, sum and last timestamp, the last value is the one of the row with the newest timestamp.
+def select_grouped(dialect_name, table, time_column, value_column, timestamp_column, bucket, criteria, aggregate):
+    # Check if the database is PostgreSQL
+    if dialect_name == "postgresql":
+        columns = table.c
+
+        # Get the last value with an ordered aggregate
+        last = func.array_agg(aggregate_order_by(columns[value_column], columns[timestamp_column].desc()))[1]
+
+    else:
+        # SQLite has no ordered aggregates (and the bare columns are ambiguous with several min/max): get the newest
+        # value of the bucket of each row with a window function, then aggregate the rows
+        rows = select(table, func.first_value(table.c[value_column]).over(
+            partition_by=bucket_expression(dialect_name, table.c[time_column], bucket),
+            order_by=table.c[timestamp_column].desc()
+        ).label("newest")).where(*criteria).subquery()
+
+        columns = rows.c
+        last = func.max(columns.newest)
+
+    bucket_number = bucket_expression(dialect_name, columns[time_column], bucket).label("bucket")
+    count, minimum, maximum, total, last_timestamp = aggregate(columns)
+
+    statement = select(bucket_number, count, minimum, maximum, total, last, last_timestamp)
+
+    # The rows of PostgreSQL are not filtered by a subquery
+    if dialect_name == "postgresql":
+        statement = statement.where(*criteria)
+
+    return statement.group_by(bucket_number).order_by(bucket_number)
+
+
+# Select the partial aggregates of the raw values of a vessel path in time buckets (seconds), oldest first:
+# (bucket number, count, min, max, sum, last, last timestamp). The end is None when open.
+def select_partials(dialect_name, table, context, start, end, bucket, include_end=True):
+    criteria = [table.c.context == context, table.c.timestamp >= start]
+
+    # Check if the window is closed
+    if end is not None:
+        criteria.append(table.c.timestamp <= end if include_end else table.c.timestamp < end)
+
+    return select_grouped(
+        dialect_name, table, "timestamp", "value", "timestamp", bucket, criteria,
+        lambda columns: (
+            func.count(columns.value), func.min(columns.value), func.max(columns.value), func.sum(columns.value),
+            func.max(columns.timestamp)
+        )
+    )
+
+
+# Select the partial aggregates of the rollups of a vessel path in time buckets (seconds), oldest first:
+# (bucket number, count, min, max, sum, last, last timestamp), from the rollup buckets in [start, end)
+def select_rollup_partials(dialect_name, rollup_table, context, start, end, bucket):
+    criteria = [rollup_table.c.context == context, rollup_table.c.bucket >= start, rollup_table.c.bucket < end]
+
+    return select_grouped(
+        dialect_name, rollup_table, "bucket", "last", "last_timestamp", bucket, criteria,
+        lambda columns: (
+            func.sum(columns["count"]), func.min(columns.min), func.max(columns.max), func.sum(columns.sum),
+            func.max(columns.last_timestamp)
+        )
+    )
+
+
+# Merge the consecutive partial aggregates of the same bucket
+def combine(partials):
+    current = None
+
+    for partial in partials:
+        bucket, count, minimum, maximum, total, last, last_timestamp = partial
+
+        # PostgreSQL gets the bucket numbers and the counts as decimals
+        bucket = int(bucket)
+        count = int(count)
+
+        # Check if the partial is of a new bucket
+        if current is None or current[0] != bucket:
+            if current is not None:
+                yield current
+            current = [bucket, count, minimum, maximum, total, last, last_timestamp]
+            continue
+
+        current[1] = current[1] + count
+        current[2] = minimum if current[2] is None else current[2] if minimum is None else min(current[2], minimum)
+        current[3] = maximum if current[3] is None else current[3] if maximum is None else max(current[3], maximum)
+        current[4] = total if current[4] is None else current[4] if total is None else current[4] + total
+
+        # Keep the newest last value
+        if last_timestamp is not None and (current[6] is None or current[6] < last_timestamp):
+            current[5] = last
+            current[6] = last_timestamp
+
+    if current is not None:
+        yield current
+
+
+# Get the aggregated value of a bucket from its partial aggregates
+def finalize(partial, aggregate):
+    if aggregate == "avg":
+        return partial[4] / partial[1] if partial[1] else None
+
+    if aggregate == "min":
+        return partial[2]
+
+    if aggregate == "max":
+        return partial[3]
+
+    # The last value
+    return partial[5]
+
+
+class RollupPlan:
+    """
+    Reads the bucketed series of a numeric path from its rollups at a resolution.
+    The rollups are complete only before the horizon (the first day still pending for the vessel, if any):
+    the values after it, and the edges of the window not aligned to the resolution, are read from the path table.
+    """
+
+    def __init__(self, table, rollup_table, seconds, horizon):
+        self.table = table
+        self.rollup_table = rollup_table
+        self.seconds = seconds
+        self.horizon = horizon
+
+    # Get the series of the vessel values aggregated in time buckets (seconds): (bucket number, value), oldest first
+    def series(self, engine, context, start, end, bucket, aggregate, yield_per=DEFAULT_YIELD_PER):
+        dialect_name = engine.dialect.name
+
+        # The rollup buckets fully inside the window
+        rollup_start = round_time(start, self.seconds, up=True)
+        rollup_end = round_time(end, self.seconds) if end is not None else None
+
+        # The rollups end at the horizon
+        if self.horizon is not None and (rollup_end is None or self.horizon < rollup_end):
+            rollup_end = self.horizon
+
+        # Check if the open window has no horizon: the rollups are complete up to now
+        if rollup_end is None:
+            rollup_end = round_time(datetime.utcnow(), self.seconds)
+
+        # Check if the window is too short to use the rollups
+        if rollup_end <= rollup_start:
+            rollup_start = rollup_end = start
+
+        segments = [
+            # The head of the window, up to the first rollup bucket
+            iter_rows(engine, select_partials(dialect_name, self.table, context, start, rollup_start, bucket,
+                                              include_end=False), yield_per),
+
+            # The rollup buckets
+            iter_rows(engine, select_rollup_partials(dialect_name, self.rollup_table, context, rollup_start,
+                                                     rollup_end, bucket), yield_per),
+
+            # The tail of the window, from the end of the rollups
+            iter_rows(engine, select_partials(dialect_name, self.table, context, rollup_end, end, bucket), yield_per)
+        ]
+
+        try:
+            for partial in combine(itertools.chain(*segments)):
+                yield partial[0], finalize(partial, aggregate)
+        finally:
+            # Give the connections back to the pool, even if the client went away
+            for rows in segments:
+                rows.close()
+
+
+# Get the plan reading the bucketed series of a vessel path from its rollups, None if the rollups can't be used
+def find_rollup(engine, registry, table, context, bucket):
+    # The rollups are kept for the numeric paths only
+    if not is_numeric(table):
+        return None
+
+    # Get the coarsest resolution the bucket is made of
+    resolution = rollup_resolution(bucket)
+    if resolution is None:
+        return None
+
+    # Check if the rollups of the path exist (they are created by the maintenance task)
+    rollup_table = registry.find(table.name + "_" + resolution[0])
+    pending = registry.find("rollup_pending")
+    if rollup_table is None or pending is None:
+        return None
+
+    # Get the first day whose rollups are not up to date
+    with connect(engine) as conn:
+        horizon = conn.execute(select(func.min(pending.c.day)).where(
+            pending.c.table_name == table.name,
+            pending.c.context == context
+        )).scalar()
+
+    return RollupPlan(table, rollup_table, resolution[1], horizon)
+
+
+# Compute the rollups of a day of a vessel path again, from its raw values
+def rollup_day(conn, registry, table, context, day):
+    next_day = day + timedelta(days=1)
+
+    # Get the minute partial aggregates of the day
+    minutes = [
+        list(row) for row in conn.execute(select_partials(
+            conn.dialect.name, table, context, day, next_day, RESOLUTIONS[0][1], include_end=False
+        ))
+    ]
+
+    # For each resolution
+    for suffix, seconds in RESOLUTIONS:
+        rollup_table = registry.rollup_table(table.name, suffix, conn)
+
+        # Merge the minutes in the buckets of the resolution
+        factor = seconds // RESOLUTIONS[0][1]
+        partials = combine([int(minute[0]) // factor] + minute[1:] for minute in minutes)
+
+        rows = [
+            {
+                "context": context,
+                "bucket": EPOCH + timedelta(seconds=partial[0] * seconds),
+                "count": partial[1],
+                "min": partial[2],
+                "max": partial[3],
+                "sum": partial[4],
+                "last": partial[5],
+                "last_timestamp": partial[6]
+            }
+            for partial in partials
+        ]
+
+        # Replace the rollups of the day
+        conn.execute(delete(rollup_table).where(
+            rollup_table.c.context == context,
+            rollup_table.c.bucket >= day,
+            rollup_table.c.bucket < next_day
+        ))
+
+        if rows:
+            conn.execute(insert(rollup_table), rows)
+
+    return len(minutes)
+
+
+# Roll up the pending days, the oldest first; returns the number of days rolled up
+def maintain_rollups(engine, registry, limit=DEFAULT_ROLLUP_BATCH):
+    pending = registry.rollup_pending_table()
+
+    # Get the pending days
+    with connect(engine) as conn:
+        days = conn.execute(select(pending).order_by(pending.c.day).limit(limit)).fetchall()
+
+    done = 0
+
+    # For each pending day
+    for table_name, context, day, marked in days:
+
+        # Get the path table (it can have been created by another worker after the registry was loaded)
+        table = registry.find(table_name)
+
+        # Check if the path table can't be found: keep the day, it is rolled up by a next run
+        if table is None:
+            log.warning("Table %s not found, day %s of %s left pending", table_name, day, context)
+            continue
+
+        # Check if the path can be rolled up
+        numeric = is_numeric(table)
+
+        # Check if the rollups of the path table must be created
+        if numeric and registry.find(table_name + "_" + RESOLUTIONS[-1][0]) is None:
+
+            # Mark all the days already stored, before the rollups can be used by the queries
+            with connect(engine) as conn, conn.begin():
+                marked_days = mark_all(conn, pending, table)
+
+            # Create the rollup tables
+            for suffix, seconds in RESOLUTIONS:
+                registry.rollup_table(table_name, suffix)
+
+            # Log an info message
+            log.info("Rollups of %s created, %s days to roll up", table_name, marked_days)
+
+        with connect(engine) as conn, registry.begin(conn):
+
+            # Compute the rollups of the day
+            if numeric:
+                rollup_day(conn, registry, table, context, day)
+                done = done + 1
+
+            # Forget the day, unless it has been marked again in the meanwhile
+            conn.execute(delete(pending).where(
+                pending.c.table_name == table_name,
+                pending.c.context == context,
+                pending.c.day == day,
+                pending.c.marked == marked
+            ))
+
+    return done
@@ -1,37 +1,37 @@
+import json
 import logging
 import os
-import tempfile
-import xml.etree.cElementTree as ET
 
-from flask import current_app, send_file, render_template, request, Response
-from sqlalchemy import create_engine
+from flask import current_app, send_file, render_template, request, Response, stream_with_context
 from werkzeug.datastructures import FileStorage
-from datetime import datetime, timedelta
+from werkzeug.http import parse_content_range_header
 
 from celery.result import AsyncResult
+from redis.exceptions import RedisError
 from flask import request, jsonify
 from flask_restx import Api, Resource, fields
 from flask_httpauth import HTTPBasicAuth
 
+from app.database import get_engine, engine_options_from_config, connect, redis_url_from_config, get_redis
+from app.metrics import generate_metrics, IngestCollector
+from app.keys import key_cache
+from app.uploads import receive_raw, receive_multipart, ResumableUpload, is_parcel
+from app.ledger import register_parcel
+from app.scheduling import enqueue_parcel
+from app.schema import get_registry
+from app.latest import select_last_positions, select_latest
+from app.state import get_latest_state
+from app.tracks import time_window, track_points, bucket_for_points, format_time, DEFAULT_YIELD_PER
+from app.timeseries import series_rows, iter_json, is_numeric, AGGREGATES, NUMERIC_AGGREGATES, MAX_PATHS, DEFAULT_POINTS
+from app.exports import FORMATS, available_formats, available_encodings, iter_compressed
+from app.rollups import find_rollup, align_bucket, rollups_enabled
+from app.spatial import select_in_bbox, select_in_radius, select_nearest, points_migrated, DEFAULT_NEAREST, \
+    MAX_NEAREST
+
 
 # Create the logger
 log = logging.getLogger('routes')
 
-# Set the default logger level as debug
-log.setLevel(logging.DEBUG)
-
-# Create the logger formatter
-fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
-
-# Get the handler
-h = logging.StreamHandler()
-
-# Set the formatter
-h.setFormatter(fmt)
-
-# Add the handler to the logger
-log.addHandler(h)
-
 # Create the api object using restx
 api = Api(current_app)
 
@@ -46,11 +46,25 @@ auth = HTTPBasicAuth()
 log.debug("Routes")
 
 
+@api.route('/metrics')
+class Metrics(Resource):
+    def get(self):
+        # Get the Celery queues
+        queues = [queue.name for queue in current_app.extensions["celery"].conf.task_queues or []]
+
+        # Add the ingestion backlog: queue depths and parcels waiting in the media root, by vessel
+        collector = IngestCollector(get_redis(redis_url_from_config(current_app.config)), queues,
+                                    current_app.config["MEDIA_ROOT"], is_parcel)
+
+        data, content_type = generate_metrics([collector])
+        return Response(data, mimetype=content_type)
+
+
 @api.route('/publickey')
 class PublicKey(Resource):
     def get(self):
         with current_app.app_context():
-            log.debug("PUBLIC_KEY_FILENAME:" + current_app.config["PUBLIC_KEY_FILENAME"])
+            log.debug("PUBLIC_KEY_FILENAME:%s", current_app.config["PUBLIC_KEY_FILENAME"])
             return send_file("../"+current_app.config["PUBLIC_KEY_FILENAME"], as_attachment=True)
 
 
@@ -89,8 +103,11 @@ class PublicKeyUpload(Resource):
             # Save the uploaded file as the file path
             uploaded_file.save(file_path)
 
+            # Drop the previous key parsed by this process
+            key_cache.invalidate(file_path)
+
             # Log the status
-            log.debug("Saved public key as: " + file_path)
+            log.debug("Saved public key as: %s", file_path)
 
             return {"result": "ok", "user": auth.current_user()}, 200
 
@@ -101,150 +118,680 @@ class PublicKeyUpload(Resource):
 # Create an api parser
 upload_parser = api.parser()
 
-# Add parser for file storage
-upload_parser.add_argument('file', location='files', type=FileStorage, required=True, help='DYNAMO log.gz.enc file')
+# Add parser for file storage (the file can be also sent as the raw application/octet-stream request body)
+upload_parser.add_argument('file', location='files', type=FileStorage, required=False, help='DYNAMO log.gz.enc file')
 
 # Add parser for session id
-upload_parser.add_argument('sessionId', required=True, help="Session unique identifier")
+upload_parser.add_argument('sessionId', required=False, help="Session unique identifier")
+
+
+# Record a received parcel in the ledger and enqueue it, unless the same parcel has been already received
+def accept_parcel(self_id, destination, file_name, size, sha256):
+    # Log a debug message
+    log.debug("Received %s (%s bytes, sha256 %s)", file_name, size, sha256)
+
+    try:
+        # Record the parcel
+        engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+        is_new = register_parcel(engine, self_id, file_name, sha256, size)
+
+    except Exception as exception:
+        # The storage is idempotent anyway, process the parcel
+        log.error("While recording the parcel: %s", exception)
+        is_new = True
+
+    # Check if the parcel has been already received (i.e. a retry after a lost response)
+    if not is_new:
+
+        # Remove the duplicate file
+        os.unlink(os.path.join(destination, file_name))
+
+        # Log an info message
+        log.info("Duplicate parcel %s from %s", sha256, self_id)
+
+        return {'result': 'ok', 'sha256': sha256, 'duplicate': True}, 200
+
+    # Processing the file is potentially time-consuming, enqueue the process (a just uploaded parcel is the most
+    # recent of the vessel, it goes in the priority queue unless another parcel of the same vessel is waiting there)
+    enqueue_parcel(self_id, file_name, sha256, latest=True)
+
+    return {'result': 'ok', 'sha256': sha256}, 200
 
 
 @api.route('/upload/<self_id>')
 @api.expect(upload_parser)
 class ParcelUpload(Resource):
     def post(self, self_id):
-        # Import the process file
-        from app.tasks import process_file_task
+        # Compose the destination directory
+        destination = os.path.join(current_app.config.get('MEDIA_ROOT'), str(self_id))
 
-        # This is FileStorage instance
-        uploaded_file = request.files['file']
+        # Check if the parcel is sent as the raw request body
+        if request.mimetype == 'application/octet-stream':
+
+            # Write the request stream straight to the parcel file
+            writer = receive_raw(request.stream, destination)
 
-        # Check if the myme is application/octet-stream
-        if uploaded_file.mimetype == 'application/octet-stream':
+        else:
+            # Parse the multipart body, writing the file part straight to the parcel file
+            writer, uploaded_file, form = receive_multipart(request.environ, destination)
 
-            # Compose the destination directory
-            destination = os.path.join(current_app.config.get('MEDIA_ROOT'), str(self_id) + "/")
+            # Check if the file is present and the mime is application/octet-stream
+            if writer is None or uploaded_file.mimetype != 'application/octet-stream':
 
-            # Check if the directory exists
-            if not os.path.exists(destination):
-                # Make the directory if needed
-                os.makedirs(destination)
+                # Discard the file
+                if writer is not None:
+                    writer.abort()
 
-            # Set the file path
-            file_path = ""
+                return {'result': 'fail', "error": "File mimetype must be application/octet-stream"}, 422
 
-            # Set the file name
-            temp_name = ""
+        # Publish the parcel in the vessel media directory
+        file_name = writer.commit()
 
-            # Until the random temporary file name is not unique...
-            done = False
-            while not done:
+        return accept_parcel(self_id, destination, file_name, writer.size, writer.hexdigest())
 
-                # Generate a temporary file name
-                temp_name = next(tempfile._get_candidate_names())
 
-                # Create a file name
-                file_path = '%s%s%s' % (destination, temp_name, '.log.gz.enc')
+# Get a resumable upload, None if it doesn't exist
+def get_resumable_upload(self_id, upload_id):
+    try:
+        upload = ResumableUpload(current_app.config.get('UPLOAD_ROOT', 'data/uploads'), self_id, upload_id)
+    except ValueError:
+        return None
 
-                # Check if the file already exists
-                if os.path.isfile(file_path) is False:
-                    # If the file doesn't exist, exit the cycle
-                    done = True
+    return upload if upload.exists() else None
 
-            # Save the uploaded file as the file path
-            uploaded_file.save(file_path)
 
-            # Processing the file is potentially time-consuming, enqueue the process
-            process_file_task.delay(self_id, temp_name + '.log.gz.enc')
+@api.route('/upload/<self_id>/resumable')
+class ResumableUploadStart(Resource):
+    def post(self, self_id):
+        # Get the optional total size and sha256 of the parcel
+        params = request.get_json(silent=True) or request.form
+
+        try:
+            size = int(params["size"]) if params.get("size") is not None else None
+        except ValueError:
+            return {'result': 'fail', 'error': 'Invalid size'}, 400
+
+        # Create the upload
+        upload = ResumableUpload.create(current_app.config.get('UPLOAD_ROOT', 'data/uploads'), self_id,
+                                        size, params.get("sha256"))
+
+        # Log a debug message
+        log.debug("Started resumable upload: %s", upload.directory)
 
-            return {'result': 'ok'}, 200
+        return {'result': 'ok', 'upload_id': upload.upload_id, 'ranges': []}, 201
+
+
+@api.route('/upload/<self_id>/resumable/<upload_id>')
+class ResumableUploadChunk(Resource):
+    def get(self, self_id, upload_id):
+        upload = get_resumable_upload(self_id, upload_id)
+        if upload is None:
+            return {'result': 'fail', 'error': 'Upload not found'}, 404
+
+        # Return the received byte ranges, so the client sends only the missing ones
+        state = upload.load_state()
+        return {'result': 'ok', 'upload_id': upload_id, 'size': state["size"], 'ranges': state["ranges"]}, 200
+
+    def put(self, self_id, upload_id):
+        upload = get_resumable_upload(self_id, upload_id)
+        if upload is None:
+            return {'result': 'fail', 'error': 'Upload not found'}, 404
+
+        # Get the chunk offset from the Content-Range header (bytes start-end/total) or from the offset argument
+        content_range = parse_content_range_header(request.headers.get('Content-Range'))
+        if content_range is not None:
+            offset = content_range.start
+            length = content_range.stop - content_range.start
         else:
-            return {'result': 'fail', "error": "File mimetype must be application/octet-stream"}, 422
+            offset = request.args.get('offset', type=int)
+            length = request.content_length
+            if offset is None:
+                return {'result': 'fail', 'error': 'Missing Content-Range header or offset argument'}, 400
+
+        try:
+            state = upload.write_chunk(offset, request.stream, length)
+        except ValueError as exception:
+            return {'result': 'fail', 'error': str(exception)}, 416
+
+        return {'result': 'ok', 'upload_id': upload_id, 'size': state["size"], 'ranges': state["ranges"]}, 200
+
+    def delete(self, self_id, upload_id):
+        upload = get_resumable_upload(self_id, upload_id)
+        if upload is None:
+            return {'result': 'fail', 'error': 'Upload not found'}, 404
+
+        upload.abort()
+
+        return {'result': 'ok'}, 200
+
+
+@api.route('/upload/<self_id>/resumable/<upload_id>/complete')
+class ResumableUploadComplete(Resource):
+    def post(self, self_id, upload_id):
+        upload = get_resumable_upload(self_id, upload_id)
+        if upload is None:
+            return {'result': 'fail', 'error': 'Upload not found'}, 404
+
+        # Compose the destination directory
+        destination = os.path.join(current_app.config.get('MEDIA_ROOT'), str(self_id))
+
+        try:
+            # Move the assembled parcel in the vessel media directory
+            file_name, size, sha256 = upload.finalize(destination)
+        except FileNotFoundError:
+            return {'result': 'fail', 'error': 'Upload not found'}, 404
+        except ValueError as exception:
+            return {'result': 'fail', 'error': str(exception), 'ranges': upload.load_state()["ranges"]}, 409
+
+        return accept_parcel(self_id, destination, file_name, size, sha256)
+
+
+@api.route('/backlog')
+class Backlog(Resource):
+    @auth.login_required
+    def post(self):
+        # Import the recovery task
+        from app.tasks import recover_backlog_task
+
+        # Enqueue the recovery of the parcels in the media root, even if one has just completed
+        result = recover_backlog_task.delay(True)
+
+        return {'result': 'ok', 'task_id': result.id}, 202
+
+
+@api.route('/backlog/<task_id>')
+class BacklogProgress(Resource):
+    def get(self, task_id):
+        # Get the recovery task status and progress
+        result = AsyncResult(task_id)
+
+        return {'result': 'ok', 'state': result.state, 'info': result.info if isinstance(result.info, dict) else None}
+
+
+# Get the latest state cache, None if disabled
+def get_state():
+    if not current_app.config.get("LATEST_CACHE", True):
+        return None
+
+    return get_latest_state(redis_url_from_config(current_app.config))
+
+
+# Read the latest values from the database and load them in the latest state cache (i.e. after a Redis restart)
+def warm_state(state, engine):
+    with connect(engine) as conn:
+        latest_values = get_registry(engine).latest_values_table()
+        rows = [row._asdict() for row in conn.execute(latest_values.select())]
+
+    state.update(rows)
+
+    # Remember the cache is loaded, even if there are no latest values yet
+    state.mark_warm()
+
+
+# Serve a JSON document with the latest state cache version as ETag (304 Not Modified if the client has it)
+def conditional_response(data, version):
+    response = jsonify(data)
+
+    # Check if the cache has a version
+    if version is not None:
+        response.set_etag(str(version))
+        response.make_conditional(request)
+
+    return response
+
+
+# Get the last positions from the database
+def query_last_positions(engine):
+    positions = []
+
+    conn = connect(engine)
+
+    try:
+        # Read the last position of each vessel from the latest values maintained at ingest time
+        latest_values = get_registry(engine).latest_values_table()
+        result = conn.execute(select_last_positions(latest_values))
+        for row in result:
+            positions.append({
+                "id": row[0].split(":")[-1],
+                "timestamp": str(row[1]),
+                "info": row[2],
+                "position": row[3]
+            })
+        conn.close()
+    except Exception as exception:
+        conn.close()
+
+    return positions
 
 
 @api.route('/lastPosition')
 class LastPosition(Resource):
     def get(self):
-        positions = []
+        engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+
+        state = get_state()
 
-        connection_string = current_app.config["CONNECTION_STRING"]
-        engine = create_engine(connection_string, echo=False)
-        conn = engine.connect()
+        # Check if the latest state cache is disabled
+        if state is None:
+            return query_last_positions(engine)
 
         try:
-            result = conn.execute(
-                "SELECT ctx.context, pos.timestamp, ctx.value as info, pos.position FROM public.context ctx, "
-                "(SELECT context, timestamp, value as position FROM public.navigation_position np1 WHERE timestamp = "
-                "(SELECT MAX(np2.timestamp) FROM public.navigation_position np2 WHERE np1.context = np2.context) "
-                "ORDER BY context) pos WHERE ctx.context = pos.context LIMIT 1;"
-            )
-            for row in result:
-                positions.append({
-                    "id": row[0].split(":")[-1],
-                    "timestamp": str(row[1]),
-                    "info": row[2],
-                    "position": row[3]
-                })
-            conn.close()
-        except Exception as exception:
-            conn.close()
+            # Check if the cache must be loaded
+            if not state.is_warm():
+                warm_state(state, engine)
+            version = state.version()
+
+            # Check if the client already has this version (the cache is not read at all)
+            if version is not None and request.if_none_match.contains(str(version)):
+                return conditional_response(None, version)
+
+            positions = []
+
+            # For each vessel in the cache
+            for context, values in state.snapshot(["", "navigation.position"]).items():
+
+                # Check if the vessel information and position are known
+                if "" in values and "navigation.position" in values:
+                    positions.append({
+                        "id": context.split(":")[-1],
+                        "timestamp": values["navigation.position"]["timestamp"],
+                        "info": values[""]["value"],
+                        "position": values["navigation.position"]["value"]
+                    })
+
+            return conditional_response(positions, version)
+
+        except RedisError as exception:
+            log.error("Latest state cache: %s", exception)
+
+        return query_last_positions(engine)
+
+
+@api.route('/latest/<self_id>')
+class Latest(Resource):
+    def get(self, self_id):
+        engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+
+        state = get_state()
+        values = None
+        version = None
+
+        # Check if the latest state cache is enabled
+        if state is not None:
+            try:
+                # Check if the cache must be loaded
+                if not state.is_warm():
+                    warm_state(state, engine)
+                version = state.version()
 
-        return positions
+                # Check if the client already has this version
+                if version is not None and request.if_none_match.contains(str(version)):
+                    return conditional_response(None, version)
+
+                values = state.values(self_id)
+
+            except RedisError as exception:
+                log.error("Latest state cache: %s", exception)
+
+        # Check if the values must be read from the database
+        if values is None:
+            values = {}
+
+            with connect(engine) as conn:
+                # Read the latest value of each path of the vessel with one query
+                latest_values = get_registry(engine).latest_values_table()
+                result = conn.execute(select_latest(latest_values, self_id))
+                for row in result:
+                    values[row[0]] = {
+                        "timestamp": str(row[1]),
+                        "source": row[2],
+                        "value": row[3]
+                    }
+
+        if not values:
+            return {'result': 'fail', 'error': 'Vessel not found'}, 404
+
+        return conditional_response({"context": self_id, "values": dict(sorted(values.items()))}, version)
+
+
+@api.route('/stream')
+class Stream(Resource):
+    def get(self):
+        state = get_state()
+
+        # Check if the latest state cache is enabled
+        if state is None:
+            return {'result': 'fail', 'error': 'Latest state cache disabled'}, 404
+
+        # Get the vessel to be followed (all by default)
+        context = request.args.get('context')
+
+        # Get the interval (in seconds) of the keep-alive comments
+        heartbeat = current_app.config.get("STREAM_HEARTBEAT", 15)
+
+        # Subscribe the changes before the response starts, so none is lost
+        pubsub = state.subscribe()
+
+        def events():
+            try:
+                # Ask the client to reconnect after 5 seconds if the connection drops
+                yield "retry: 5000\n\n"
+
+                while True:
+                    # Wait for a change
+                    message = pubsub.get_message(timeout=heartbeat)
+
+                    # Check if nothing changed in the meanwhile
+                    if message is None:
+
+                        # Keep the connection alive through the proxies
+                        yield ": keep-alive\n\n"
+                        continue
+
+                    data = message["data"].decode("utf-8")
+
+                    # Check if the change is about the followed vessel
+                    if context is not None and json.loads(data)["context"] != context:
+                        continue
+
+                    # Push the change
+                    yield "event: update\ndata: " + data + "\n\n"
+
+            finally:
+                pubsub.close()
+
+        return Response(events(), mimetype='text/event-stream', headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
+
+
+# Get a positive number from the request arguments, None if not set (ValueError if not valid)
+def positive_arg(name, number_type):
+    value = request.args.get(name)
+
+    # Check if the argument is set
+    if value is None:
+        return None
+
+    # Convert the value (a ValueError is raised if it isn't a number)
+    number = number_type(value)
+
+    # Check if the number is positive
+    if not number > 0:
+        raise ValueError("The " + name + " argument must be a positive number")
+
+    return number
+
+
+# Stream the track of a vessel in an export format, compressed if the client accepts it
+def track_response(self_id, format_name, mimetype=None):
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+
+    # Get the time window
+    start, end = time_window(request.args)
+
+    try:
+        # Get the track reduction: number of points, time bucket (seconds), simplification tolerance (meters)
+        points = positive_arg('points', int)
+        bucket = positive_arg('bucket', int)
+        tolerance = positive_arg('tolerance', float)
+    except ValueError as exception:
+        return {'result': 'fail', 'error': str(exception)}, 400
+
+    # Check if the format is available
+    if format_name not in available_formats():
+        return {'result': 'fail', 'error': 'Format not available: ' + str(format_name),
+                'formats': available_formats()}, 400
+
+    # Get the format writer
+    writer, format_mimetype, extension, compressible = FORMATS[format_name]
+
+    # Get the positions table (it can have been created by a worker after the registry was loaded)
+    table = get_registry(engine).find("navigation_position")
+
+    # Check if any position has been stored
+    if table is None:
+        points = []
+    else:
+        # Get the points, streamed from a server-side cursor unless simplified
+        points = track_points(engine, table, self_id, start, end, points, bucket, tolerance,
+                              current_app.config.get("TRACK_YIELD_PER", DEFAULT_YIELD_PER))
+
+    chunks = writer(points, self_id)
+    headers = {}
+
+    # Check if the response must be compressed
+    if compressible:
+        headers["Vary"] = "Accept-Encoding"
+
+        # Get the encoding preferred by the client
+        encoding = request.accept_encodings.best_match(available_encodings())
+        if encoding is not None:
+            chunks = iter_compressed(chunks, encoding)
+            headers["Content-Encoding"] = encoding
+
+    return Response(stream_with_context(chunks), mimetype=mimetype or format_mimetype, headers=headers)
 
 
 @api.route('/gpx/<self_id>')
 class GPX(Resource):
     def get(self, self_id):
-        query = "SELECT * FROM public.navigation_position WHERE context='" + self_id + "' "
+        return track_response(self_id, "gpx", 'text/xml')
 
-        connection_string = current_app.config["CONNECTION_STRING"]
-        engine = create_engine(connection_string, echo=False)
-        conn = engine.connect()
 
-        gpx = ET.Element("gpx", attrib={"xmlns": "http://www.topografix.com/GPX/1/1"})
-        trk = ET.SubElement(gpx, "trk")
-        trkseg = ET.SubElement(trk, "trkseg")
+@api.route('/track/<self_id>')
+class Track(Resource):
+    def get(self, self_id):
+        # Get the export format (gpx, geojson, csv or parquet)
+        format_name = request.args.get('format', 'gpx')
 
-        start = request.args.get('start')
-        end = request.args.get('end')
-        hours = request.args.get('hours')
-        minutes = request.args.get('minutes')
-        seconds = request.args.get('seconds')
+        response = track_response(self_id, format_name)
 
-        try:
-            if start is not None and end is not None:
-                startTime = datetime.strptime(start, '%Y%m%dZ%H%M%S')
-                endTime = datetime.strptime(end, '%Y%m%dZ%H%M%S')
-                query += f"AND timestamp >= '{startTime}' AND timestamp <= '{endTime}' ".format(startTime, endTime)
+        # Check if the track is being streamed
+        if isinstance(response, Response):
+            response.headers["Content-Disposition"] = 'inline; filename="' + self_id.split(":")[-1] + "." + \
+                                                      FORMATS[format_name][2] + '"'
+
+        return response
 
-            elif start is not None and (hours is not None or minutes is not None or seconds is not None):
-                startTime = datetime.strptime(start, '%Y%m%dZ%H%M%S')
-                endTime = startTime + timedelta(hours=int(hours or 0), minutes=int(minutes or 0),
-                                                seconds=int(seconds or 0))
-                query += f"AND timestamp >= '{startTime}' AND timestamp <= '{endTime}' ".format(startTime, endTime)
 
-            elif end is not None and (hours is not None or minutes is not None or seconds is not None):
-                endTime = datetime.strptime(end, '%Y%m%dZ%H%M%S')
-                startTime = endTime - timedelta(hours=int(hours or 0), minutes=int(minutes or 0),
-                                                seconds=int(seconds or 0))
-                query += f"AND timestamp >= '{startTime}' AND timestamp <= '{endTime}' ".format(startTime, endTime)
+@api.route('/timeseries/<self_id>/<path>')
+class TimeSeries(Resource):
+    def get(self, self_id, path):
+        engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
 
-            else:
-                query += "AND timestamp >= NOW() - INTERVAL '15 minutes' "
+        # Get the paths: comma separated, and/or as path arguments
+        paths = [item for item in path.split(",") + request.args.getlist('path') if item]
 
-        except Exception as e:
-            query += "AND timestamp >= NOW() - INTERVAL '15 minutes' "
+        # Get the time window
+        start, end = time_window(request.args)
 
-        query += "ORDER BY timestamp ASC;"
+        # Get the aggregate of the values in a bucket
+        aggregate = request.args.get('aggregate', 'avg')
 
         try:
-            result = conn.execute(query)
+            # Get the bucket (seconds), or the number of points the window is divided in
+            bucket = positive_arg('bucket', int)
+            points = positive_arg('points', int)
+        except ValueError as exception:
+            return {'result': 'fail', 'error': str(exception)}, 400
+
+        # Check the request
+        if len(paths) > MAX_PATHS:
+            return {'result': 'fail', 'error': 'Too many paths, at most ' + str(MAX_PATHS)}, 400
+
+        if aggregate not in AGGREGATES:
+            return {'result': 'fail', 'error': 'Unknown aggregate, use one of ' + ", ".join(AGGREGATES)}, 400
+
+        # Check if the values can be read from the rollups
+        rollups = rollups_enabled(current_app.config)
+
+        # Several paths are aligned on a shared time grid
+        if bucket is None and (points is not None or len(paths) > 1):
+            bucket = bucket_for_points(start, end, points or DEFAULT_POINTS)
+
+            # Use a grid the rollups are made of
+            if rollups:
+                bucket = align_bucket(bucket)
+
+        # Resolve the paths to their tables
+        registry = get_registry(engine)
+        tables = []
+        for item in paths:
+            table = registry.stored_path_table(item)
+
+            # Check if the path is stored
+            if table is None:
+                return {'result': 'fail', 'error': 'Path not found: ' + item}, 404
+
+            # Check if the path can be aggregated
+            if bucket is not None and aggregate in NUMERIC_AGGREGATES and not is_numeric(table):
+                return {'result': 'fail', 'error': 'Path not numeric: ' + item + ', use the last aggregate'}, 400
+
+            tables.append(table)
+
+        # Get the rollups of each path, if they can be used
+        plans = None
+        if rollups and bucket is not None:
+            plans = [find_rollup(engine, registry, table, self_id, bucket) for table in tables]
+
+        header = {
+            "context": self_id,
+            "start": format_time(start),
+            "end": format_time(end) if end is not None else None,
+            "bucket": bucket,
+            "aggregate": aggregate if bucket is not None else None,
+            "columns": ["timestamp"] + paths
+        }
+
+        # Stream the rows while they are read from the server-side cursors
+        rows = series_rows(engine, tables, self_id, start, end, bucket, aggregate,
+                           current_app.config.get("TRACK_YIELD_PER", DEFAULT_YIELD_PER), plans)
+
+        return Response(stream_with_context(iter_json(header, rows)), mimetype='application/json')
+
+
+# Get a coordinate (degrees) from the request arguments, None if not set (ValueError if not valid)
+def coordinate_arg(name, limit):
+    value = request.args.get(name)
+
+    # Check if the argument is set
+    if value is None:
+        return None
+
+    # Convert the value (a ValueError is raised if it isn't a number)
+    number = float(value)
+
+    # Check if the coordinate is in range
+    if not -limit <= number <= limit:
+        raise ValueError("The " + name + " argument must be between " + str(-limit) + " and " + str(limit))
+
+    return number
+
+
+# Run a spatial query on the positions table and serve the vessels found
+def vessels_response(build_statement):
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+
+    # The spatial queries require PostGIS
+    if engine.dialect.name != "postgresql":
+        return {'result': 'fail', 'error': 'Spatial queries not supported by ' + engine.dialect.name}, 501
+
+    # Get the positions table (it can have been created by a worker after the registry was loaded)
+    registry = get_registry(engine)
+    table = registry.find("navigation_position")
+
+    # Check if any position has been stored
+    if table is None:
+        return []
+
+    # The points written by the previous versions must be migrated first (migrate_points_task)
+    if not points_migrated(engine, registry, table.name):
+        return {'result': 'fail', 'error': 'Positions not migrated yet, run app.tasks.migrate_points_task'}, 409
+
+    # Get the positions table again, reflected with the computed point column
+    table = registry.find(table.name)
+
+    vessels = []
+
+    try:
+        with connect(engine) as conn:
+            result = conn.execute(build_statement(registry, table))
             for row in result:
-                trkpt = ET.SubElement(trkseg, "trkpt", attrib={"lat": str(row[5]), "lon": str(row[4])})
-                ET.SubElement(trkpt, "time").text = str(row[1])
+                vessel = {
+                    "id": row.context.split(":")[-1],
+                    "context": row.context,
+                    "timestamp": format_time(row.timestamp),
+                    "lon": row.lon,
+                    "lat": row.lat
+                }
+
+                # Add the distance (meters), if computed
+                if "distance" in row._fields:
+                    vessel["distance"] = row.distance
+
+                vessels.append(vessel)
+
+    except Exception as exception:
+        log.error("While querying the positions: %s", exception)
+        return {'result': 'fail', 'error': 'Spatial query failed'}, 500
+
+    return vessels
+
+
+@api.route('/vessels/within')
+class VesselsWithin(Resource):
+    def get(self):
+        # Get the time window
+        start, end = time_window(request.args)
 
-            conn.close()
-        except Exception as e:
-            log.error("SQL: " + str(e))
-            conn.close()
+        try:
+            # Check if a bounding box is requested (min lon, min lat, max lon, max lat)
+            bbox = request.args.get('bbox')
+            if bbox is not None:
+                corners = [float(item) for item in bbox.split(",")]
+
+                # Check the bounding box
+                if len(corners) != 4 or not corners[0] <= corners[2] or not corners[1] <= corners[3]:
+                    raise ValueError("The bbox argument must be min_lon,min_lat,max_lon,max_lat")
+
+                return vessels_response(lambda registry, table: select_in_bbox(table, start, end, *corners))
+
+            # Otherwise a circle is requested (center and radius in meters)
+            lon = coordinate_arg('lon', 180)
+            lat = coordinate_arg('lat', 90)
+            radius = positive_arg('radius', float)
+
+        except ValueError as exception:
+            return {'result': 'fail', 'error': str(exception)}, 400
+
+        if lon is None or lat is None or radius is None:
+            return {'result': 'fail', 'error': 'Set bbox, or lon, lat and radius'}, 400
 
-        return Response(ET.tostring(gpx), mimetype='text/xml')
+        return vessels_response(lambda registry, table: select_in_radius(table, start, end, lon, lat, radius))
+
+
+@api.route('/vessels/nearest')
+class VesselsNearest(Resource):
+    def get(self):
+        # Get the time window
+        start, end = time_window(request.args)
+
+        try:
+            # Get the point and the number of vessels
+            lon = coordinate_arg('lon', 180)
+            lat = coordinate_arg('lat', 90)
+            limit = positive_arg('limit', int) or DEFAULT_NEAREST
+        except ValueError as exception:
+            return {'result': 'fail', 'error': str(exception)}, 400
+
+        if lon is None or lat is None:
+            return {'result': 'fail', 'error': 'Set lon and lat'}, 400
+
+        if limit > MAX_NEAREST:
+            return {'result': 'fail', 'error': 'Too many vessels, at most ' + str(MAX_NEAREST)}, 400
+
+        return vessels_response(lambda registry, table: select_nearest(
+            table, registry.latest_values_table(), start, end, lon, lat, limit
+        ))
@@ -0,0 +1,65 @@
+import zlib
+
+from flask import current_app
+from kombu import Queue
+
+from app.database import get_redis, redis_url_from_config
+
+# The queue of the most recent parcel of each vessel, so the latest data is stored during backlog drains
+PRIORITY_QUEUE = "parcels.priority"
+
+# The prefix of the queues sharding the parcels by vessel
+SHARD_QUEUE_PREFIX = "parcels."
+
+# The default number of shard queues
+DEFAULT_SHARDS = 8
+
+# The prefix of the Redis keys marking a vessel having a parcel in the priority queue
+PRIORITY_KEY_PREFIX = "dynamo:priority:"
+
+
+# Get the number of shard queues from the application configuration
+def shards_from_config(config):
+    return config.get("PARCEL_QUEUE_SHARDS", DEFAULT_SHARDS)
+
+
+# Get the shard queue of a vessel (a vessel always goes in the same queue, so it can't starve the others)
+def shard_queue(self_id, shards):
+    return SHARD_QUEUE_PREFIX + str(zlib.crc32(str(self_id).encode("utf-8")) % shards)
+
+
+# Get all the parcel queues
+def parcel_queues(shards):
+    return [Queue(PRIORITY_QUEUE)] + [Queue(SHARD_QUEUE_PREFIX + str(shard)) for shard in range(shards)]
+
+
+# Try to reserve the priority lane for a vessel: at most one parcel of each vessel waits in the priority queue
+def claim_priority(self_id):
+    client = get_redis(redis_url_from_config(current_app.config))
+    ttl = current_app.config.get("PRIORITY_TTL", 3600)
+    return bool(client.set(PRIORITY_KEY_PREFIX + str(self_id), 1, nx=True, ex=ttl))
+
+
+# Release the priority lane of a vessel, once its parcel is being processed
+def release_priority(self_id):
+    client = get_redis(redis_url_from_config(current_app.config))
+    client.delete(PRIORITY_KEY_PREFIX + str(self_id))
+
+
+# Get the signature processing a parcel, routed to the priority queue or to the vessel shard queue
+def parcel_signature(self_id, file_name, sha256=None, latest=False):
+    # Import the process file
+    from app.tasks import process_file_task
+
+    # Check if the parcel is the most recent of the vessel and the priority lane is free
+    if latest and claim_priority(self_id):
+        return process_file_task.signature((self_id, file_name, sha256), {"priority": True}, queue=PRIORITY_QUEUE)
+
+    return process_file_task.signature(
+        (self_id, file_name, sha256), queue=shard_queue(self_id, shards_from_config(current_app.config))
+    )
+
+
+# Enqueue a parcel
+def enqueue_parcel(self_id, file_name, sha256=None, latest=False):
+    return parcel_signature(self_id, file_name, sha256, latest).apply_async()
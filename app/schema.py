@@ -0,0 +1,431 @@
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import Column, Table, JSON, Text, Float, BigInteger, MetaData, DateTime, Index, Computed, DDL, inspect, \
+    insert, text
+from sqlalchemy.dialects import postgresql, sqlite
+from geoalchemy2 import Geometry
+
+from app.database import connect
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The process-wide table registries, one for each engine
+_registries = {}
+
+# Protect the registries dictionary
+_registries_lock = threading.Lock()
+
+# The spatial reference of the position points (WGS 84 longitude, latitude)
+SRID = 4326
+
+# The point of a position, computed by the database from the longitude and latitude columns
+POINT_EXPRESSION = "ST_SetSRID(ST_MakePoint(lon, lat), " + str(SRID) + ")"
+
+# The tables not storing a path
+INTERNAL_TABLES = ("sources", "parcels", "latest_values", "rollup_pending")
+
+# The name of a table derived from a path table: a partition (p202301, default, with a counter if the name was taken)
+# or a rollups table (1m, 1h, 1d)
+DERIVED_TABLE_PATTERN = re.compile(r"^(.+)_(p[0-9]+|default|1m|1h|1d)(_[0-9]+)?$")
+
+# The columns of a path table
+PATH_COLUMNS = ("context", "timestamp", "value")
+
+# The seconds a table found missing in the catalog is not looked up again
+MISSING_TABLE_TTL = 60
+
+
+# Create an insert statement skipping the rows conflicting with an existing primary key
+def insert_ignore(conn, table):
+    # Check if the dialect supports ON CONFLICT DO NOTHING
+    if conn.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+
+    if conn.dialect.name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+
+    return insert(table)
+
+
+# Get the table name used to store a Signal K path
+def table_name_for_path(path):
+    # Check if the path is empty
+    if path == "":
+        # The context information is stored in the "context" table
+        return "context"
+
+    # Create the table name
+    return path.replace(".", "_")
+
+
+# Define the sources table
+def define_sources_table(metadata):
+    return Table("sources", metadata,
+                 Column('context', Text, nullable=False, primary_key=True),
+                 Column('label', Text, nullable=False, primary_key=True),
+                 Column('type', Text, nullable=False),
+                 Column('value', JSON)
+                 )
+
+
+# Define the ledger of the received parcels, identified by their content hash
+def define_parcels_table(metadata):
+    return Table("parcels", metadata,
+                 Column('sha256', Text, nullable=False, primary_key=True),
+                 Column('context', Text, nullable=False),
+                 Column('file_name', Text),
+                 Column('size', BigInteger),
+                 Column('status', Text, nullable=False),
+                 Column('received', DateTime, nullable=False),
+                 Column('processed', DateTime)
+                 )
+
+
+# Define the table of the latest value of each vessel path, maintained at ingest time
+def define_latest_values_table(metadata):
+    return Table("latest_values", metadata,
+                 Column('context', Text, nullable=False, primary_key=True),
+                 Column('path', Text, nullable=False, primary_key=True),
+                 Column('timestamp', DateTime, nullable=False),
+                 Column('source', Text),
+                 Column('value', JSON),
+                 Index('latest_values_path', 'path')
+                 )
+
+
+# Define the table of the rollups of a numeric path table at a resolution (one row for each vessel and time bucket)
+def define_rollup_table(metadata, table_name):
+    return Table(table_name, metadata,
+                 Column('context', Text, nullable=False, primary_key=True),
+                 Column('bucket', DateTime, nullable=False, primary_key=True),
+                 Column('count', BigInteger, nullable=False),
+                 Column('min', Float),
+                 Column('max', Float),
+                 Column('sum', Float),
+                 Column('last', Float),
+                 Column('last_timestamp', DateTime)
+                 )
+
+
+# Define the table of the days whose rollups must be computed again, by path table and vessel
+def define_rollup_pending_table(metadata):
+    return Table("rollup_pending", metadata,
+                 Column('table_name', Text, nullable=False, primary_key=True),
+                 Column('context', Text, nullable=False, primary_key=True),
+                 Column('day', DateTime, nullable=False, primary_key=True),
+                 Column('marked', DateTime, nullable=False)
+                 )
+
+
+# Define the table storing a Signal K path (partition_by is the PostgreSQL partitioning clause, if any)
+def define_path_table(metadata, table_name, path, value_data, partition_by=None):
+    # Get the table options
+    options = {}
+
+    # Check if the table must be partitioned (the primary key includes the partition key)
+    if partition_by is not None:
+        options["postgresql_partition_by"] = partition_by
+
+        # The rows falling in an interval without a partition are stored in the default partition, created with the
+        # table (the maintenance task moves them to the partition of their interval)
+        options["listeners"] = [
+            ("after_create", DDL(
+                'CREATE TABLE "' + table_name + '_default" PARTITION OF "' + table_name + '" DEFAULT'
+            ).execute_if(dialect="postgresql"))
+        ]
+
+    # Check if the path is related to a position
+    if path == "navigation.position":
+
+        # Define the data table
+        return Table(table_name, metadata,
+                     Column('context', Text, nullable=False, primary_key=True),
+                     Column('timestamp', DateTime, nullable=False, primary_key=True),
+                     Column('source', Text, nullable=False, primary_key=True),
+                     Column('value', JSON),
+                     Column('lon', Float),
+                     Column('lat', Float),
+                     # The point is computed by the database and has a GiST index (created with the table)
+                     Column('point', Geometry('POINT', srid=SRID), Computed(POINT_EXPRESSION, persisted=True)),
+                     **options
+                     )
+
+    # Check if the value is a dictionary
+    if isinstance(value_data, dict):
+
+        # Set the value type as JSON
+        value_datatype = JSON
+
+    # Check if the value is a string
+    elif isinstance(value_data, str):
+
+        # Set the value type as text
+        value_datatype = Text
+
+    # Otherwise consider the value as a float
+    else:
+
+        # Set the value type as Float
+        value_datatype = Float
+
+    # Define the data table
+    return Table(table_name, metadata,
+                 Column('context', Text, nullable=False, primary_key=True),
+                 Column('timestamp', DateTime, nullable=False, primary_key=True),
+                 Column('source', Text, nullable=False, primary_key=True),
+                 Column('value', value_datatype),
+                 **options
+                 )
+
+
+class TableRegistry:
+    """
+    Per-process cache of the tables used to store the Signal K data.
+    The existing tables are reflected from the catalog once, the missing ones are created once
+    (serialized by an advisory lock), so the ingestion hot path doesn't issue any DDL round trip.
+    The tables missing in a transaction begun with begin() are created on its connection, in a savepoint,
+    and shared with the other threads only once the transaction has been committed.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.metadata = MetaData()
+        self.loaded = False
+        self.lock = threading.RLock()
+
+        # The tables created in the open transactions, by connection
+        self.created = {}
+
+        # The tables found missing in the catalog, with the time they have been looked up
+        self.missing = {}
+
+    # Reflect the existing tables from the catalog
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                # Reflect all the tables at once
+                self.metadata.reflect(self.engine)
+
+                # Set the registry as loaded
+                self.loaded = True
+
+                # Log a debug message
+                log.debug("Reflected %s tables", len(self.metadata.tables))
+
+    # Forget a table, so it is reflected again (i.e. after its columns have been changed)
+    def refresh(self, table_name):
+        with self.lock:
+            table = self.metadata.tables.get(table_name)
+            if table is not None:
+                self.metadata.remove(table)
+
+    # Get a table by name, None if not available
+    def get(self, table_name):
+        # Load the registry if needed
+        if not self.loaded:
+            self.load()
+
+        return self.metadata.tables.get(table_name)
+
+    # Get a table by name, reflecting it if it has been created by another process; None if it doesn't exist
+    # (a missing table is looked up in the catalog again only after MISSING_TABLE_TTL seconds)
+    def find(self, table_name):
+        # Get the table from the registry (hot path)
+        table = self.get(table_name)
+
+        # Check if the table is already known
+        if table is not None:
+            return table
+
+        # Check if the table has been found missing recently
+        if time.monotonic() - self.missing.get(table_name, -MISSING_TABLE_TTL) < MISSING_TABLE_TTL:
+            return None
+
+        with self.lock, connect(self.engine) as conn:
+            # Check again, another thread could have added the table in the meanwhile
+            table = self.metadata.tables.get(table_name)
+
+            # Check if the table exists
+            if table is None and inspect(conn).has_table(table_name):
+
+                # Reflect the table
+                table = Table(table_name, self.metadata, autoload_with=conn)
+
+        # Remember when the table has been found missing
+        if table is None:
+            self.missing[table_name] = time.monotonic()
+        else:
+            self.missing.pop(table_name, None)
+
+        return table
+
+    # Get the table storing a path, None if the path is not stored: the internal tables and the tables derived from
+    # a path table (partitions, rollups) can't be read as a path, even if the path name maps to them
+    def stored_path_table(self, path):
+        # Get the table, from the catalog if it has been created after the registry was loaded (i.e. by a worker)
+        table = self.find(table_name_for_path(path))
+        if table is None:
+            return None
+
+        # Check if the table is an internal one
+        if table.name in INTERNAL_TABLES:
+            return None
+
+        # Check if the table is derived from a path table
+        match = DERIVED_TABLE_PATTERN.match(table.name)
+        if match is not None and self.find(match.group(1)) is not None:
+            return None
+
+        # Check if the table has the columns of a path table
+        if any(column not in table.c for column in PATH_COLUMNS):
+            return None
+
+        return table
+
+    # Begin a transaction on a connection, creating the missing tables on the connection itself (no other
+    # connection is needed while the transaction holds its locks); the created tables are shared once committed
+    @contextmanager
+    def begin(self, conn):
+        # The tables created in the transaction
+        created = self.created[conn] = MetaData()
+
+        try:
+            with conn.begin() as transaction:
+                yield transaction
+
+            # Share the created tables, now that they are durable
+            with self.lock:
+                for table in created.tables.values():
+                    if table.name not in self.metadata.tables:
+                        table.to_metadata(self.metadata)
+                    self.missing.pop(table.name, None)
+
+        finally:
+            # Forget the tables of the transaction (if rolled back, they don't exist anymore)
+            del self.created[conn]
+
+    # Get the sources table, creating it if needed
+    def sources_table(self, conn=None):
+        return self._ensure("sources", define_sources_table, conn)
+
+    # Get the parcels ledger table, creating it if needed
+    def parcels_table(self, conn=None):
+        return self._ensure("parcels", define_parcels_table, conn)
+
+    # Get the latest values table, creating it if needed
+    def latest_values_table(self, conn=None):
+        return self._ensure("latest_values", define_latest_values_table, conn)
+
+    # Get the table of the days whose rollups must be computed again, creating it if needed
+    def rollup_pending_table(self, conn=None):
+        return self._ensure("rollup_pending", define_rollup_pending_table, conn)
+
+    # Get the rollups table of a path table at a resolution (i.e. 1m), creating it if needed
+    def rollup_table(self, table_name, resolution, conn=None):
+        rollup_name = table_name + "_" + resolution
+        return self._ensure(rollup_name, lambda metadata: define_rollup_table(metadata, rollup_name), conn)
+
+    # Get the table storing a path, creating it if needed (partitioned if partition_by is set)
+    def path_table(self, path, value_data, partition_by=None, conn=None):
+        # Get the table name
+        table_name = table_name_for_path(path)
+
+        return self._ensure(
+            table_name,
+            lambda metadata: define_path_table(metadata, table_name, path, value_data, partition_by),
+            conn
+        )
+
+    # Get a table, creating it once if it doesn't exist: on the connection, if its transaction has been begun
+    # with begin(), on a connection of its own otherwise
+    def _ensure(self, table_name, define, conn=None):
+        # Get the table from the registry (hot path)
+        table = self.get(table_name)
+
+        # Check if the table is already known
+        if table is not None:
+            return table
+
+        # Get the tables created in the transaction of the connection, if any
+        created = self.created.get(conn) if conn is not None else None
+
+        # Check if the table must be created in the transaction of the caller
+        if created is not None:
+
+            # Get the table, if already created in the transaction
+            table = created.tables.get(table_name)
+            if table is None:
+                table = self._create(conn, table_name, define, created)
+
+            return table
+
+        with self.lock:
+            # Check again, another thread could have added the table in the meanwhile
+            table = self.metadata.tables.get(table_name)
+
+            if table is None:
+                with connect(self.engine) as conn, conn.begin():
+                    table = self._create(conn, table_name, define, self.metadata)
+
+                # The table isn't missing anymore
+                self.missing.pop(table_name, None)
+
+        return table
+
+    # Reflect a table created by another process, or create it, defining it in the metadata
+    def _create(self, conn, table_name, define, metadata):
+        # Use a savepoint, so a failed creation doesn't abort the transaction of the caller
+        with conn.begin_nested():
+
+            # Serialize the creation among the workers: the lock is held until the transaction ends,
+            # so the other workers wait for the table to be committed
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": table_name})
+
+            # Check if the table has been created by another process
+            if inspect(conn).has_table(table_name):
+
+                with self.lock:
+                    # Reflect the table, unless another thread has done it in the meanwhile
+                    table = self.metadata.tables.get(table_name)
+                    if table is None:
+                        table = Table(table_name, self.metadata, autoload_with=conn)
+
+                # Log a debug message
+                log.debug("Table %s reflected", table_name)
+
+            else:
+                # Define the table
+                table = define(metadata)
+
+                try:
+                    # Create the table
+                    table.create(conn)
+
+                except Exception:
+                    # Forget the definition, so the creation is tried again next time
+                    metadata.remove(table)
+                    raise
+
+                # Log a debug message
+                log.debug("Table %s created!", table_name)
+
+        return table
+
+
+# Get the process-wide table registry for the engine
+def get_registry(engine):
+    # Get the registry, if already created
+    registry = _registries.get(engine.url)
+
+    # Check if the registry must be created
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.setdefault(engine.url, TableRegistry(engine))
+
+    return registry
@@ -0,0 +1,165 @@
+import logging
+import math
+
+from sqlalchemy import select, func, cast, text, true
+from geoalchemy2 import Geography
+
+from app.database import connect
+from app.schema import SRID, POINT_EXPRESSION
+from app.tracks import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The default and maximum number of vessels returned by a nearest query
+DEFAULT_NEAREST = 1
+MAX_NEAREST = 100
+
+# The positions tables known to have the computed point column, as (engine URL, table name)
+_migrated = set()
+
+
+# Get a point geometry from its coordinates
+def make_point(lon, lat):
+    return func.ST_SetSRID(func.ST_MakePoint(lon, lat), SRID)
+
+
+# Get a point as geography, so the distances are in meters on the spheroid
+def as_geography(point):
+    return cast(point, Geography("POINT", srid=SRID))
+
+
+# Restrict a statement on a path table to a time window (the end is None when open)
+def in_window(statement, table, start, end):
+    statement = statement.where(table.c.timestamp >= start)
+
+    # Check if the window is closed
+    if end is not None:
+        statement = statement.where(table.c.timestamp <= end)
+
+    return statement
+
+
+# Select the last position in a time window of each vessel having a position in a bounding box
+# (context, timestamp, lon, lat), by vessel
+def select_in_bbox(table, start, end, min_lon, min_lat, max_lon, max_lat):
+    envelope = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, SRID)
+
+    statement = select(table.c.context, table.c.timestamp, table.c.lon, table.c.lat).distinct(
+        table.c.context
+    ).where(
+        # The GiST index finds the points in the box
+        func.ST_Intersects(table.c.point, envelope)
+    )
+
+    return in_window(statement, table, start, end).order_by(table.c.context, table.c.timestamp.desc())
+
+
+# Select the last position in a time window of each vessel having a position within a radius (meters) from a point
+# (context, timestamp, lon, lat, distance), nearest first
+def select_in_radius(table, start, end, lon, lat, radius):
+    center = make_point(lon, lat)
+
+    # The box around the circle in degrees, so the GiST index can be used (the exact check is done in meters)
+    cos_lat = max(math.cos(math.radians(lat)), 0.01)
+    box = func.ST_Expand(center, radius / (METERS_PER_DEGREE_LON * cos_lat), radius / METERS_PER_DEGREE_LAT)
+
+    distance = func.ST_Distance(as_geography(table.c.point), as_geography(center))
+
+    positions = select(
+        table.c.context, table.c.timestamp, table.c.lon, table.c.lat, distance.label("distance")
+    ).distinct(table.c.context).where(
+        table.c.point.op("&&")(box),
+        func.ST_DWithin(as_geography(table.c.point), as_geography(center), radius)
+    )
+
+    positions = in_window(positions, table, start, end).order_by(
+        table.c.context, table.c.timestamp.desc()
+    ).subquery()
+
+    return select(positions).order_by(positions.c.distance)
+
+
+# Select the vessels nearest to a point, by their nearest position in a time window
+# (context, timestamp, lon, lat, distance), nearest first
+def select_nearest(table, latest_values, start, end, lon, lat, limit=DEFAULT_NEAREST):
+    center = make_point(lon, lat)
+
+    # The vessels having a position, from the latest values maintained at ingest time
+    vessels = select(latest_values.c.context).where(latest_values.c.path == "navigation.position").subquery()
+
+    # The nearest position of each vessel (KNN ordering)
+    nearest = select(
+        table.c.timestamp, table.c.lon, table.c.lat,
+        func.ST_Distance(as_geography(table.c.point), as_geography(center)).label("distance")
+    ).where(table.c.context == vessels.c.context)
+
+    nearest = in_window(nearest, table, start, end).order_by(
+        table.c.point.op("<->")(center)
+    ).limit(1).lateral("nearest")
+
+    return select(
+        vessels.c.context, nearest.c.timestamp, nearest.c.lon, nearest.c.lat, nearest.c.distance
+    ).select_from(vessels.join(nearest, true())).order_by(nearest.c.distance).limit(limit)
+
+
+# Check if the point column of a table is computed by the database
+def has_computed_point(conn, table_name):
+    result = conn.execute(text(
+        "SELECT is_generated FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table_name AND column_name = 'point'"
+    ), {"table_name": table_name}).scalar()
+
+    return result == "ALWAYS"
+
+
+# Check if a positions table has been migrated to the computed point column (the spatial queries can't use the
+# points written by the previous versions): the catalog is queried until it has
+def points_migrated(engine, registry, table_name):
+    # Check if the table is already known to be migrated
+    if (engine.url, table_name) in _migrated:
+        return True
+
+    with connect(engine) as conn:
+        migrated = has_computed_point(conn, table_name)
+
+    if migrated:
+        # Reflect the table again, in case it has been reflected before the migration
+        registry.refresh(table_name)
+
+        # Remember the table is migrated
+        _migrated.add((engine.url, table_name))
+
+    return migrated
+
+
+# Migrate the point column of a positions table: the points written by the previous versions have the axes
+# reversed and no SRID, so the column is replaced with one computed from the longitude and latitude
+# (filling the existing rows), then the spatial index is created. Returns True if the column was replaced.
+def migrate_points(conn, table_name):
+    # Serialize the migration with the table creation
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": table_name})
+
+    migrated = False
+
+    # Check if the column must be replaced (the table is rewritten, holding an exclusive lock)
+    if not has_computed_point(conn, table_name):
+        conn.execute(text(
+            'ALTER TABLE "' + table_name + '" DROP COLUMN IF EXISTS point, ' +
+            'ADD COLUMN point geometry(POINT, ' + str(SRID) + ') GENERATED ALWAYS AS (' + POINT_EXPRESSION +
+            ') STORED'
+        ))
+        migrated = True
+
+        # Log an info message
+        log.info("Points of %s recomputed", table_name)
+
+    # Create the spatial index (created on each partition of a partitioned table)
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS "idx_' + table_name + '_point" ON "' + table_name + '" USING gist (point)'
+    ))
+
+    # Refresh the statistics used by the planner
+    conn.execute(text('ANALYZE "' + table_name + '"'))
+
+    return migrated
@@ -0,0 +1,164 @@
+import json
+import logging
+
+from app.database import get_redis
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The prefix of the hashes holding the latest values of a vessel (path -> JSON value)
+VALUES_KEY_PREFIX = "dynamo:latest:values:"
+
+# The prefix of the hashes holding the timestamps of the latest values of a vessel (path -> ISO 8601 timestamp)
+TIMESTAMPS_KEY_PREFIX = "dynamo:latest:timestamps:"
+
+# The set of the vessels in the cache
+CONTEXTS_KEY = "dynamo:latest:contexts"
+
+# The version of the cache, incremented at each change (used as ETag)
+VERSION_KEY = "dynamo:latest:version"
+
+# Set once the cache has been loaded from the database (it disappears with the cache, i.e. after a Redis restart)
+WARMED_KEY = "dynamo:latest:warmed"
+
+# The channel where the changes are published
+UPDATES_CHANNEL = "dynamo:latest:updates"
+
+# The process-wide latest state caches, one for each Redis URL
+_states = {}
+
+# Set the values newer than the cached ones: the cache is never moved backwards by a late parcel.
+# KEYS: values hash, timestamps hash, contexts set, version. ARGV: context, then path, timestamp, value triples.
+# Returns the new version and the changed paths, or nothing if no value changed.
+UPDATE_SCRIPT = """
+local changed = {}
+for i = 2, #ARGV, 3 do
+    local current = redis.call('HGET', KEYS[2], ARGV[i])
+    if not current or current < ARGV[i + 1] then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        changed[#changed + 1] = ARGV[i]
+    end
+end
+if #changed == 0 then
+    return nil
+end
+redis.call('SADD', KEYS[3], ARGV[1])
+return {redis.call('INCR', KEYS[4]), changed}
+"""
+
+
+class LatestState:
+    """
+    Redis cache of the latest value of each vessel path, shared by the web replicas and the workers.
+    The workers update it after a parcel is committed and publish the changes, the routes serve
+    the dashboards from it (with the cache version as ETag) and push the changes to the subscribers.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.update_script = client.register_script(UPDATE_SCRIPT)
+
+    # Get the current version, None if the cache is empty
+    def version(self):
+        version = self.client.get(VERSION_KEY)
+        return None if version is None else int(version)
+
+    # Check if the cache has been loaded from the database (the version is set by the first update, even by a worker)
+    def is_warm(self):
+        return self.client.exists(WARMED_KEY) > 0
+
+    # Remember the cache has been loaded from the database
+    def mark_warm(self):
+        self.client.set(WARMED_KEY, 1)
+
+    # Set the latest rows (context, path, timestamp, source, value) newer than the cached ones, publishing the changes
+    def update(self, rows):
+        # Group the rows by vessel
+        contexts = {}
+        for row in rows:
+            contexts.setdefault(row["context"], []).append(row)
+
+        # For each vessel
+        for context, context_rows in contexts.items():
+
+            # Serialize the values
+            entries = {}
+            args = [context]
+            for row in context_rows:
+                entry = {"timestamp": str(row["timestamp"]), "source": row["source"], "value": row["value"]}
+                entries[row["path"]] = entry
+                args.extend([row["path"], sortable_timestamp(row["timestamp"]), json.dumps(entry)])
+
+            # Update the cache atomically
+            result = self.update_script(
+                keys=[VALUES_KEY_PREFIX + context, TIMESTAMPS_KEY_PREFIX + context, CONTEXTS_KEY, VERSION_KEY],
+                args=args
+            )
+
+            # Check if some values changed
+            if result is None:
+                continue
+
+            version, changed = result
+
+            # Publish the changed values
+            self.client.publish(UPDATES_CHANNEL, json.dumps({
+                "context": context,
+                "version": version,
+                "values": {path.decode("utf-8"): entries[path.decode("utf-8")] for path in changed}
+            }))
+
+    # Get the latest values of a vessel, by path
+    def values(self, context, paths=None):
+        # Check if only some paths are needed
+        if paths is not None:
+            values = self.client.hmget(VALUES_KEY_PREFIX + context, paths)
+            return {path: json.loads(value) for path, value in zip(paths, values) if value is not None}
+
+        return {
+            path.decode("utf-8"): json.loads(value)
+            for path, value in self.client.hgetall(VALUES_KEY_PREFIX + context).items()
+        }
+
+    # Get the vessels in the cache
+    def contexts(self):
+        return sorted(context.decode("utf-8") for context in self.client.smembers(CONTEXTS_KEY))
+
+    # Get the latest values of some paths of all the vessels, by vessel, with one round trip
+    def snapshot(self, paths):
+        # Get the vessels
+        contexts = self.contexts()
+
+        # Get the values of all the vessels at once
+        pipeline = self.client.pipeline(transaction=False)
+        for context in contexts:
+            pipeline.hmget(VALUES_KEY_PREFIX + context, paths)
+
+        return {
+            context: {path: json.loads(value) for path, value in zip(paths, values) if value is not None}
+            for context, values in zip(contexts, pipeline.execute())
+        }
+
+    # Subscribe the changes
+    def subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(UPDATES_CHANNEL)
+        return pubsub
+
+
+# Get the process-wide latest state cache for the Redis URL
+def get_latest_state(url):
+    # Get the cache, if already created
+    state = _states.get(url)
+
+    # Check if the cache must be created
+    if state is None:
+        state = _states.setdefault(url, LatestState(get_redis(url)))
+
+    return state
+
+
+# Format a timestamp with a fixed width, so the timestamps compare as strings
+def sortable_timestamp(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')
@@ -1,28 +1,25 @@
 import logging
 
-from sqlalchemy import create_engine, Column, Table, JSON, Text, Float, MetaData, DateTime, select, insert
-from geoalchemy2 import Geometry
+from sqlalchemy import create_engine, MetaData, JSON, select
+
+from app.database import get_engine, connect
+from app.schema import get_registry, insert_ignore
+from app.columnar import ColumnarParser
+from app.partitions import partition_by
+from app.latest import latest_rows, merge_latest, upsert_latest
+from app.rollups import dirty_days, mark_dirty
+from app.timeseries import is_numeric
+from app.metrics import StageTimer, DB_ERRORS
+from app.logs import SAMPLED
 
-import json
 import datetime
+import fnmatch
+import io
+import json
 
 # Create the logger
 log = logging.getLogger('app')
 
-# Set the default logger level as debug
-log.setLevel(logging.DEBUG)
-
-# Create the logger formatter
-fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
-
-# Get the handler
-h = logging.StreamHandler()
-
-# Set the formatter
-h.setFormatter(fmt)
-
-# Add the handler to the logger
-log.addHandler(h)
 
 def store_updatelist_csv(update_list, options):
     csv_root = options["csv_root"]
@@ -48,288 +45,331 @@ def store_updatelist_csv(update_list, options):
                     fd.write(row)
 
 
-# Perform update list storage
-def store_updatelist(update_list, options):
-    # Get the connection string
-    connection_string = options["connection_string"]
+# Default number of rows sent to the database server with a single multi-row insert
+DEFAULT_BATCH_SIZE = 1000
 
-    # Connect the database server
-    engine = create_engine(connection_string, echo=False)
 
-    # Retrieve the metadata
-    metadata = MetaData()
+# Get the number of rows written by an insert skipping the conflicting rows (the batch size if unknown)
+def written_rows(rowcount, rows):
+    return rowcount if rowcount >= 0 else len(rows)
 
-    # For each update item in the update list
-    for update_item in update_list:
 
-        # Skip this iteration if context is not in the update item
-        if "context" not in update_item:
+# Write a batch of rows in a table, returning the number of rows written (the rows already stored are skipped)
+def flush_rows(conn, table, rows):
+    # Nothing to do if the batch is empty
+    if not rows:
+        return 0
 
-            # Log a error message
-            log.error("Context not present in the update item")
+    try:
+        # Use a savepoint, so a failing batch doesn't abort the parcel transaction
+        with conn.begin_nested():
 
-            # Go to the next update item
-            continue
+            # Insert all the rows at once (executemany / multi-VALUES insert), skipping the rows already stored
+            result = conn.execute(insert_ignore(conn, table), rows)
 
-        # Get the context
-        context = update_item["context"]
+        # Get the number of rows actually written
+        written = written_rows(result.rowcount, rows)
 
         # Log a debug message
-        log.debug("Processing context:"+context)
+        log.debug("Added %s rows to %s", written, table.name)
 
-        # Skip this iteration if updates is not in the update item
-        if "updates" not in update_item:
+        return written
 
-            # Log a error message
-            log.error("The updates array is not present in the update item")
+    except Exception as exception:
 
-            # Go to the next update item
-            continue
+        # Count the error
+        DB_ERRORS.labels(table.name, "insert").inc()
 
-        # Get the updates
-        updates = update_item["updates"]
+        # Log a warning message
+        log.warning("While adding a batch to %s: %s", table.name, exception)
 
-        # For each update in the updates array
-        for update in updates:
+    # Set the number of stored rows, and of the rows processed without error (stored or already stored)
+    stored = 0
+    processed = 0
 
-            # Check if the mandatory timestamp for the update is set
-            if "timestamp" not in update:
+    # Fall back to one row at time, so only the offending rows are discarded
+    for row in rows:
+        try:
+            # Use a savepoint for each row
+            with conn.begin_nested():
 
-                # Log a error message
-                log.error("The timestamp is not present in the update")
+                # Insert the row
+                result = conn.execute(insert_ignore(conn, table), row)
 
-                # Go to the next update
-                continue
+            # Count the row
+            stored = stored + written_rows(result.rowcount, [row])
+            processed = processed + 1
 
-            # Get the timestamp
-            timestamp = datetime.datetime.strptime(update["timestamp"], '%Y-%m-%dT%H:%M:%S.%fZ')
+        except Exception as exception:
 
-            # Set the source to  none
-            source = None
+            # Count the error
+            DB_ERRORS.labels(table.name, "insert_row").inc()
 
-            # Set the source reference to none
-            source_ref = None
+            # Log a debug message, sampled: all the rows of a batch can fail
+            log.debug("While adding a row to %s: %s", table.name, exception, extra=SAMPLED)
 
-            # Check if the update has a source reference
-            if "$source" in update:
-                # Get the source reference
-                source_ref = update["$source"]
+    # Check if some rows have been discarded
+    if processed < len(rows):
 
-            # Check if the source full description is present
-            if source_ref is None and "source" in update:
+        # Log an error message, once for the batch
+        log.error("Discarded %s of %s rows of %s", len(rows) - processed, len(rows), table.name)
 
-                # Get the source full description
-                source = update["source"]
+    return stored
 
-                # Check if the label is present
-                if "label" in source:
-                    # Get the source reference
-                    source_ref = source["label"]
 
-            # Log da debug message
-            log.debug(str(timestamp) + " source_ref: " + source_ref)
+# Check if the rows of a path must be loaded with COPY (the patterns are shell-style, i.e. "environment.wind.*")
+def uses_copy(path, copy_paths):
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in copy_paths)
 
-            # Set the sources table reference to none
-            sources_table = None
 
-            # Check if the table "sources" must be created
-            if source is not None and "sources" not in metadata.tables:
+# Format a value as a PostgreSQL CSV field (an unquoted empty field is NULL)
+def format_copy_value(value, is_json):
+    # Check if the value is null
+    if value is None:
+        return ""
 
-                # Define the sources table
-                sources_table = Table("sources", metadata,
-                                      Column('context', Text, nullable=False, primary_key=True),
-                                      Column('label', Text, nullable=False, primary_key=True),
-                                      Column('type', Text, nullable=False),
-                                      Column('value', JSON)
-                                      )
+    # Serialize the JSON values
+    if is_json:
+        value = json.dumps(value)
 
-                # Create the sources table
-                metadata.create_all(engine)
+    # Check if the value is a string
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
 
-                # Log a debug message
-                log.debug("Created table: sources")
+    # Check if the value is a timestamp
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
 
-            # Check if the table "sources" exists
-            if "sources" in metadata.tables:
+    return str(value)
 
-                # Search for the source_ref in the table
 
-                sql_string = select("sources").where("label" == source_ref)
+# Write a column batch in a table with a multi-row INSERT
+def insert_batch(conn, table, batch):
+    return flush_rows(conn, table, batch.rows())
 
-                try:
-                    with engine.connect() as conn:
-                        result = conn.execute(sql_string)
 
-                        # Check if the source label is not present
-                        if result.rowcount == 0:
-                            params = {
-                                "context": context,
-                                "label": source_ref,
-                                "type": source["type"],
-                                "value": source
-                            }
+# Get the fields of a column batch, by column name, as loaded by COPY
+def copy_fields(batch):
+    fields = {
+        "context": batch.contexts,
+        "timestamp": batch.isoformats(),
+        "source": batch.sources,
+        "value": batch.values
+    }
 
-                            # Prepare the sql string for the insert given the parameters above
-                            sql_string = insert(sources_table).values(params)
+    # Check if the path is related to a position
+    if batch.lon is not None:
+        fields["lon"] = batch.lon.tolist()
+        fields["lat"] = batch.lat.tolist()
 
-                            # Execute the insert
-                            conn.execute(sql_string)
+    return fields
 
-                            # Commit the changes
-                            conn.commit()
 
-                            # Log a debug message
-                            log.debug("Added " + source_ref + "to the sources table")
+# Write a column batch in a table using COPY into a staging table merged into the target table
+def copy_batch(conn, table, batch):
+    # Nothing to do if the batch is empty
+    if not len(batch):
+        return 0
 
-                except Exception as exception:
-                    log.error("SQL:" + str(exception))
+    # COPY is available on PostgreSQL only
+    if conn.dialect.name != "postgresql":
+        return insert_batch(conn, table, batch)
 
-                    continue
+    # Get the fields of the batch
+    fields = copy_fields(batch)
 
-            # Check if the update has a list of values
-            if "values" not in update: #and update["values"]:
+    # Get the column names (the ones the batch has a field for)
+    columns = [column for column in table.columns if column.name in fields]
 
-                # Log an error message
-                log.error("values not in the update")
+    # Format the CSV one column at time
+    formatted = [
+        [format_copy_value(value, isinstance(column.type, JSON)) for value in fields[column.name]]
+        for column in columns
+    ]
 
-                # Go to the next update
-                continue
+    # Stage the rows in an in-memory CSV buffer
+    buffer = io.StringIO()
+    for row in zip(*formatted):
+        buffer.write(",".join(row))
+        buffer.write("\n")
+    buffer.seek(0)
 
-            # Get the list of values
-            values = update["values"]
+    # Quote the table and column names
+    target = '"' + table.name + '"'
+    staging = '"staging_' + table.name + '"'
+    column_list = ", ".join('"' + column.name + '"' for column in columns)
 
-            # For each value in the list of values
-            for value in values:
+    try:
+        # Use a savepoint, so a failing batch doesn't abort the parcel transaction
+        with conn.begin_nested():
 
-                # Check if the path is present
-                if "path" in value:
-
-                    # Get the path
-                    path = value["path"]
-
-                    # Check if the path is empty
-                    if path == "":
-
-                        # Set the table name as "context"
-                        table_name = "context"
-
-                    else:
-                        # Create the table name
-                        table_name = path.replace(".", "_")
-
-                    # Get the value
-                    value_data = value["value"]
-
-                    # Check if the table must be created
-                    if table_name not in metadata.tables:
-
-                        # Check if the path is related to a position
-                        if path == "navigation.position":
-
-                            # Define the data table
-                            Table(table_name, metadata,
-                                  Column('context', Text, nullable=False, primary_key=True),
-                                  Column('timestamp', DateTime, nullable=False, primary_key=True),
-                                  Column('source', Text, nullable=False, primary_key=True),
-                                  Column('value', JSON),
-                                  Column('lon', Float),
-                                  Column('lat', Float),
-                                  Column('point', Geometry('POINT'))
-                                  )
-                        else:
-                            # Check if the value is a dictionary
-                            if isinstance(value_data, dict):
-
-                                # Set the value type as JSON
-                                value_datatype = JSON
-
-                            # Check if the value is a string
-                            elif isinstance(value_data, str):
-
-                                # Set the value type as text
-                                value_datatype = Text
-
-                            # Otherwise consider the value as a float
-                            else:
-
-                                # Set the value type as Float
-                                value_datatype = Float
-
-                            # Define the data table
-                            Table(table_name, metadata,
-                                  Column('context', Text, nullable=False, primary_key=True),
-                                  Column('timestamp', DateTime, nullable=False, primary_key=True),
-                                  Column('source', Text, nullable=False, primary_key=True),
-                                  Column('value', value_datatype)
-                                  )
-                        # Create the table
-                        metadata.create_all(engine)
-
-                        # Log a debug message
-                        log.debug("Table " + table_name + " created!")
-
-                    # Get the table reference
-                    data_table = metadata.tables[table_name]
-
-                    # Check if the table reference is consistent
-                    if data_table is None:
-
-                        # Log an error message
-                        log.error("Table " + table_name + " not present.")
-
-                        # Go to the next value
-                        continue
-
-                    # Check if the path is a position
-                    if path == "navigation.position":
-
-                        # Prepare the parameters considering the position as geographic point
-                        params = {
-                            "context": context,
-                            "timestamp": timestamp,
-                            "source": source_ref,
-                            "value": value_data,
-                            "lon": value_data["longitude"],
-                            "lat": value_data["latitude"],
-                            "point": "POINT (" +
-                                     str(value_data["latitude"]) + " " + str(value_data["longitude"]) +
-                                     ")"
-                        }
-                    else:
-
-                        # Prepare the parameters
-                        params = {
-                            "context": context,
-                            "timestamp": timestamp,
-                            "source": source_ref,
-                            "value": value_data
-                        }
+            # Get the DBAPI cursor, sharing the parcel transaction
+            cursor = conn.connection.dbapi_connection.cursor()
+
+            # The staging table is a temporary table: it is not WAL-logged and private to the session
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS " + staging +
+                           " (LIKE " + target + " INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+
+            # Load the rows
+            cursor.copy_expert("COPY " + staging + " (" + column_list + ") FROM STDIN WITH (FORMAT csv)", buffer)
+
+            # Merge the rows skipping the ones already stored
+            cursor.execute("INSERT INTO " + target + " (" + column_list + ") SELECT " + column_list +
+                           " FROM " + staging + " ON CONFLICT DO NOTHING")
+
+            # Get the number of rows actually written
+            written = written_rows(cursor.rowcount, batch)
+
+            # Empty the staging table for the next batch
+            cursor.execute("TRUNCATE " + staging)
+
+            cursor.close()
+
+        # Log a debug message
+        log.debug("Copied %s rows to %s", written, table.name)
+
+        return written
+
+    except Exception as exception:
+
+        # Count the error
+        DB_ERRORS.labels(table.name, "copy").inc()
+
+        # Log a warning message
+        log.warning("While copying a batch to %s: %s", table.name, exception)
+
+    # Fall back to the inserts
+    return insert_batch(conn, table, batch)
+
+
+# Perform update list storage
+def store_updatelist(update_list, options):
+    # Get the connection string
+    connection_string = options["connection_string"]
+
+    # Get the number of rows to be written with a single insert
+    batch_size = options.get("batch_size", DEFAULT_BATCH_SIZE)
+
+    # Get the paths loaded with COPY instead of INSERT
+    copy_paths = options.get("copy_paths", [])
+
+    # Get the process-wide engine
+    engine = get_engine(connection_string, options.get("engine_options"))
+
+    # Get the process-wide table registry
+    registry = get_registry(engine)
+
+    # Get the partitioning of the new path tables (the rows without a partition go in the default partition,
+    # the partitions are created by the maintenance task: no DDL is issued on an existing partitioned table)
+    partitioning = options.get("partitioning")
+
+    # Get the timer measuring the parse stage (the time spent in the database is the rest)
+    timer = options.get("timer") or StageTimer()
+
+    # Turn the update items into per-path column batches
+    parser = ColumnarParser(batch_size)
+
+    # The function writing the batches of each path
+    writers = {}
+
+    # The latest row of each context and path in the parcel
+    latest = {}
+
+    # Check if the rollups of the numeric paths are maintained
+    rollups = options.get("rollups", False)
+
+    # The days whose rollups must be computed again: (table name, context, day)
+    dirty = set()
+
+    # The number of rows written in the database
+    stored = 0
+
+    # Write a column batch in the table of its path
+    def write(batch):
+        # Keep the latest rows of the batch
+        merge_latest(latest, latest_rows(batch))
+
+        # Get the table reference, creating the table in the parcel transaction if needed
+        data_table = registry.path_table(batch.path, batch.values[0], partition_by(partitioning), conn)
+
+        # Check if the days of the batch must be rolled up
+        if rollups and batch.numeric is not None and is_numeric(data_table):
+            dirty.update((data_table.name, context, day) for context, day in dirty_days(batch))
+
+        # Check if the writer for the table must be chosen
+        if data_table not in writers:
+
+            # Use COPY for the configured high-volume paths, INSERT otherwise
+            writers[data_table] = copy_batch if uses_copy(batch.path, copy_paths) else insert_batch
+
+        # Write the batch
+        return writers[data_table](conn, data_table, batch)
+
+    # Use one transaction for the whole parcel: if iterating the update list raises (i.e. the streamed
+    # parcel has an invalid signature) the transaction is rolled back and nothing is made durable,
+    # not even the tables created for the parcel
+    with connect(engine) as conn, registry.begin(conn):
+
+        # For each update item in the update list
+        for update_item in update_list:
+
+            # Get the batches filled by the update item
+            with timer.stage("parse"):
+                batches = parser.feed(update_item)
+
+            # For each batch filled by the update item
+            for batch in batches:
+
+                # Write the batch
+                stored = stored + write(batch)
+
+        # Get the batches still waiting to be written
+        with timer.stage("parse"):
+            batches = parser.drain()
+
+        # For each batch still waiting to be written
+        for batch in batches:
+
+            # Write the remaining rows
+            stored = stored + write(batch)
+
+        # Check if there are sources to be added to the sources table
+        if parser.sources:
+
+            # Write the sources with INSERT
+            stored = stored + flush_rows(conn, registry.sources_table(conn), parser.sources)
 
-                    # Create the sql string
-                    sql_string = insert(data_table).values(params)
+        # Mark the days to be rolled up, in the parcel transaction so no stored row is missed
+        if dirty:
+            mark_dirty(conn, registry.rollup_pending_table(conn), dirty)
 
-                    # Log a debug message
-                    log.debug("SQL string: " + str(sql_string))
+        try:
+            # Get the latest values table, out of the savepoint: rolling it back would drop a table just created
+            latest_values = registry.latest_values_table(conn)
 
-                    try:
-                        # Create a connection
-                        with engine.connect() as conn:
+            # Use a savepoint, so the parcel is stored even if the latest values can't be updated
+            with conn.begin_nested():
 
-                            # Insert data
-                            conn.execute(sql_string)
+                # Update the latest values with the newer rows of the parcel
+                upsert_latest(conn, latest_values, list(latest.values()))
 
-                            # Commit the changes
-                            conn.commit()
+        except Exception as exception:
 
-                            # Log a debug message
-                            log.debug("Added: " + context + "." + path + " -> " + str(value_data))
+            # Count the error
+            DB_ERRORS.labels("latest_values", "upsert").inc()
 
-                    except Exception as exception:
+            # Log a warning message
+            log.warning("While updating the latest values: %s", exception)
 
-                        # Log a debug message
-                        log.error("While adding data: " + str(exception))
+    # Check if the latest rows must be handed over once the parcel is committed (i.e. to the latest state cache)
+    on_commit = options.get("on_commit")
+    if on_commit is not None:
+        on_commit(list(latest.values()))
 
+    # Log a debug message
+    log.debug("Stored %s rows", stored)
 
+    return stored
 
 
 def main():
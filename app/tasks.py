@@ -1,39 +1,80 @@
-import tempfile
 import os
-import shutil
 import logging
+import time
 
 from flask import current_app
 
-from celery import shared_task
+from celery import shared_task, group
 from celery import Task
-from app.uncompress import get_encoded_encrypted_symmetric_key, get_symmetric_key, uncrypt_update_list
-from app.storage import store_updatelist
+from app.uncompress import read_key_header, get_symmetric_key, iter_update_list
+from app.storage import store_updatelist, DEFAULT_BATCH_SIZE
+from app.decoders import get_decoder
+from app.database import get_engine, engine_options_from_config, get_redis, redis_url_from_config, connect
+from app.uploads import is_parcel
+from app.scheduling import parcel_signature, release_priority
+from app.ledger import mark_parcel, PROCESSED, FAILED
+from app.partitions import get_partition_manager
+from app.schema import get_registry, table_name_for_path
+from app.latest import backfill_latest
+from app.state import get_latest_state
+from app.spatial import migrate_points
+from app.metrics import StageTimer, PARCEL_BYTES, PARCEL_ROWS, PARCELS
+from app.rollups import maintain_rollups, rollups_enabled, DEFAULT_ROLLUP_BATCH
 
 log = logging.getLogger('tasks')
-log.setLevel(logging.DEBUG)  # DEBUG
 
-fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
-h = logging.StreamHandler()
-h.setFormatter(fmt)
-log.addHandler(h)
+
+# Update the latest state cache with the rows of a committed parcel, publishing the changes to the dashboards
+def publish_latest(state, rows):
+    # Check if the cache is enabled
+    if state is None:
+        return
+
+    try:
+        state.update(rows)
+    except Exception as exception:
+        # The cache is only an accelerator: the rows are already committed in the database
+        log.error("While updating the latest state cache: %s", exception)
 
 
 @shared_task(bind=True, ignore_result=False)
-def process_file_task(self: Task, directory: str, file_item: str):
+def process_file_task(self: Task, directory: str, file_item: str, sha256: str = None, priority: bool = False):
+
+    # Check if the parcel comes from the priority queue
+    if priority:
+
+        # Free the priority lane, so the next parcel of the vessel can use it
+        release_priority(directory)
 
     # Retrieve the media root (where the flask route saves the "type.context/...log.gz.enc" files
     media_root = current_app.config["MEDIA_ROOT"]
 
-    # Retrieve the scratch root (where the "type.context/...log.gz.enc" files are unzipped, decrypted and processed.
-    scratch_root = current_app.config["SCRATCH_ROOT"]
-
     # Retrieve the trash root (where the "type.context/...log.gz.enc" files are stored before removed forever)
     trash_root = current_app.config["TRASH_ROOT"]
 
     # Get the connection string
     connection_string = current_app.config["CONNECTION_STRING"]
 
+    # Get the database engine options
+    engine_options = engine_options_from_config(current_app.config)
+
+    # Get the number of rows written with a single insert
+    batch_size = current_app.config.get("STORAGE_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+
+    # Get the paths loaded with COPY
+    copy_paths = current_app.config.get("COPY_PATHS", [])
+
+    # Get the partitioning of the path tables
+    partitioning = current_app.config.get("PARTITIONING")
+
+    # Get the latest state cache, if enabled
+    state = None
+    if current_app.config.get("LATEST_CACHE", True):
+        state = get_latest_state(redis_url_from_config(current_app.config))
+
+    # Get the function decoding the JSON lines of the parcel
+    decoder = get_decoder(current_app.config.get("JSON_DECODER", "auto"))
+
     # Get the local private key file name
     private_key_filename = current_app.config["PRIVATE_KEY_FILENAME"]
 
@@ -51,42 +92,276 @@ def process_file_task(self: Task, directory: str, file_item: str):
 
             src_path = media_root + "/" + directory + "/" + file_item
 
-            log.info("Processing: " + src_path)
-            try:
-                os.makedirs(scratch_root + "/" + directory)
-            except FileExistsError as e:
-                pass
+            # Check if the parcel is still there (it can be enqueued twice, i.e. by the backlog recovery or a task
+            # redelivery, and the first run has already moved it to the trash): leave its ledger entry as it is
+            if not os.path.isfile(src_path):
+                log.info("Parcel already processed: %s", src_path)
+                return
+
+            log.info("Processing: %s", src_path)
+
+            # Set the parcel status for the ledger
+            status = FAILED
 
-            scratch_dir = tempfile.mkdtemp(dir=scratch_root + "/" + directory)
-            enc_path = scratch_dir + "/" + file_item
+            # Measure the time spent in each stage of the processing
+            timer = StageTimer()
 
             try:
+                # Record the parcel size
+                PARCEL_BYTES.observe(os.path.getsize(src_path))
+
                 log.debug("Get Encoded Encrypted Symmetric Key")
-                encoded_encrypted_symmetric_key = get_encoded_encrypted_symmetric_key(src_path, enc_path)
+                # The encrypted body is read in place, starting from the offset just after the key header
+                with timer.stage("key_header"):
+                    encoded_encrypted_symmetric_key, offset = read_key_header(src_path)
 
                 log.debug("Get Symmetric Key")
-                symmetric_key = get_symmetric_key(private_key_filename, encoded_encrypted_symmetric_key)
+                with timer.stage("rsa_unwrap"):
+                    symmetric_key = get_symmetric_key(private_key_filename, encoded_encrypted_symmetric_key)
 
                 log.debug("Decrypt the Update List")
-                update_list = uncrypt_update_list(public_key_filename, symmetric_key, enc_path)
+                # The update list is streamed: the signature is checked after the last update has been
+                # read, and store_updatelist rolls back the parcel transaction if the check fails
+                update_list = iter_update_list(public_key_filename, symmetric_key, src_path, offset, decoder, timer)
 
                 log.debug("Store the Update List")
-                store_updatelist(update_list, {"connection_string": connection_string})
+                # The stages of the streamed update list are measured apart from the database writes
+                with timer.stage("db_write"):
+                    stored = store_updatelist(update_list, {
+                        "connection_string": connection_string,
+                        "engine_options": engine_options,
+                        "batch_size": batch_size,
+                        "copy_paths": copy_paths,
+                        "partitioning": partitioning,
+                        "rollups": rollups_enabled(current_app.config),
+                        "timer": timer,
+                        "on_commit": lambda rows: publish_latest(state, rows)
+                    })
+
+                # Record the rows of the parcel
+                PARCEL_ROWS.observe(stored)
 
-                shutil.rmtree(scratch_dir)
-                log.debug("Removed scratch directory: " + scratch_dir)
+                status = PROCESSED
 
             except Exception as exception:
                 log.error(exception)
 
-            try:
-                os.makedirs(trash_root + "/" + directory)
+            # Record the stage timings and the parcel status
+            timer.observe()
+            PARCELS.labels(status).inc()
+
+            # Check if the parcel is recorded in the ledger (parcels found in the media root at startup are not)
+            if sha256 is not None:
+                try:
+                    # Update the parcel status, a failed parcel can be uploaded again
+                    mark_parcel(get_engine(connection_string, engine_options), sha256, status)
+                except Exception as exception:
+                    log.error("While updating the parcel ledger: %s", exception)
+
+            os.makedirs(trash_root + "/" + directory, exist_ok=True)
 
+            try:
+                # Move the parcel to the trash
                 os.rename(src_path, trash_root + "/" + directory + "/" + file_item)
-            except FileExistsError as e:
-                pass
+            except FileNotFoundError:
+                # Another run of the same parcel has moved it in the meanwhile
+                log.info("Parcel already moved to the trash: %s", src_path)
 
         else:
-            log.debug("Public key file missing: " + public_key_filename)
+            log.debug("Public key file missing: %s", public_key_filename)
     else:
-        log.debug("Private key file missing: " + private_key_filename)
+        log.debug("Private key file missing: %s", private_key_filename)
+
+
+# The Redis key of the backlog recovery lock
+BACKLOG_LOCK_KEY = "dynamo:backlog:lock"
+
+# The Redis key set when a backlog recovery completes
+BACKLOG_DONE_KEY = "dynamo:backlog:done"
+
+
+# Scan the media root
+def scan_backlog(media_root):
+    # For each directory in the media root (each directory is a vessel uuid)...
+    with os.scandir(media_root) as directories:
+        for directory in directories:
+            if directory.is_dir():
+
+                # For each file in the directory. Each file contains a data parcel.
+                with os.scandir(directory.path) as files:
+                    parcels = [
+                        (file_item.stat().st_mtime, file_item.name) for file_item in files
+                        if file_item.is_file() and is_parcel(file_item.name)
+                    ]
+
+                # Sort the parcels from the oldest to the most recent
+                parcels.sort()
+
+                yield directory.name, [file_item for _, file_item in parcels]
+
+
+@shared_task(bind=True, ignore_result=False)
+def recover_backlog_task(self: Task, force: bool = False):
+    # Get the number of parcels enqueued at once
+    batch_size = current_app.config.get("BACKLOG_BATCH_SIZE", 500)
+
+    # Get how long (in seconds) a completed recovery prevents a new one (i.e. from other web replicas starting up)
+    cooldown = current_app.config.get("BACKLOG_COOLDOWN", 600)
+
+    # Get the Redis client
+    client = get_redis(redis_url_from_config(current_app.config))
+
+    # Check if a recovery has been recently completed
+    if not force and client.exists(BACKLOG_DONE_KEY):
+        log.info("Backlog recently recovered, skipping")
+        return {"skipped": True}
+
+    # Only one recovery at time among all the replicas
+    lock = client.lock(BACKLOG_LOCK_KEY, timeout=3600, blocking=False)
+    if not lock.acquire():
+        log.info("Backlog recovery already running, skipping")
+        return {"skipped": True}
+
+    try:
+        log.info("Start %s...", time.strftime("%A, %d. %B %Y %I:%M:%S %p"))
+
+        scanned = 0
+        batch = []
+
+        # For each vessel in the media root
+        for directory, file_items in scan_backlog(current_app.config["MEDIA_ROOT"]):
+
+            # Check if the vessel has parcels
+            if not file_items:
+                continue
+
+            # The most recent parcel goes first, in the priority queue, the others in the vessel shard queue
+            batch.append(parcel_signature(directory, file_items[-1], latest=True))
+            batch.extend(parcel_signature(directory, file_item) for file_item in file_items[:-1])
+            scanned = scanned + len(file_items)
+
+            # Check if the batch is full
+            if len(batch) >= batch_size:
+
+                # Enqueue the batch at once
+                group(batch).apply_async()
+                batch = []
+
+                # Report the progress
+                self.update_state(state="PROGRESS", meta={"enqueued": scanned})
+
+                # Keep the lock while the recovery is running
+                lock.extend(3600, replace_ttl=True)
+
+        # Enqueue the remaining parcels
+        if batch:
+            group(batch).apply_async()
+
+        # Prevent the other replicas from recovering the same backlog
+        client.set(BACKLOG_DONE_KEY, time.time(), ex=cooldown)
+
+        log.info("... %s finish: %s parcels enqueued.", time.strftime("%A, %d. %B %Y %I:%M:%S %p"), scanned)
+
+        return {"enqueued": scanned}
+
+    finally:
+        lock.release()
+
+
+@shared_task(bind=True, ignore_result=False)
+def maintain_partitions_task(self: Task):
+    # Get the database engine
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+
+    # Get the partition manager
+    partitions = get_partition_manager(engine, current_app.config.get("PARTITIONING"))
+
+    # Check if the partitioning is enabled
+    if partitions is None:
+        log.info("Partitioning not enabled, skipping")
+        return {"skipped": True}
+
+    # Create the next partitions and apply the retention policy
+    removed = partitions.maintain_all()
+
+    log.info("Partitions maintained, %s removed", len(removed))
+
+    return {"removed": removed}
+
+
+@shared_task(bind=True, ignore_result=False)
+def backfill_latest_values_task(self: Task, paths: list = None):
+    # Get the paths to be backfilled, by default the ones shown by the dashboard (vessel information and position)
+    if paths is None:
+        paths = ["", "navigation.position"]
+
+    # Get the database engine and the table registry
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+    registry = get_registry(engine)
+
+    # Get the latest values table, creating it if needed
+    latest_values = registry.latest_values_table()
+
+    filled = {}
+
+    # For each path
+    for path in paths:
+
+        # Get the path table, if it exists (it can have been created after the registry was loaded)
+        data_table = registry.find(table_name_for_path(path))
+        if data_table is None:
+            continue
+
+        with connect(engine) as conn, conn.begin():
+            filled[path] = backfill_latest(conn, latest_values, data_table, path)
+
+        log.info("Latest values of '%s' backfilled: %s", path, filled[path])
+
+    return {"filled": filled}
+
+
+@shared_task(bind=True, ignore_result=False)
+def migrate_points_task(self: Task):
+    # Get the database engine and the table registry
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+    registry = get_registry(engine)
+
+    # Get the positions table, if it exists (it can have been created after the registry was loaded)
+    table_name = table_name_for_path("navigation.position")
+    if registry.find(table_name) is None:
+        log.info("No positions stored, skipping")
+        return {"skipped": True}
+
+    # The spatial queries require PostGIS
+    if engine.dialect.name != "postgresql":
+        log.info("Spatial index not supported by %s, skipping", engine.dialect.name)
+        return {"skipped": True}
+
+    with connect(engine) as conn, conn.begin():
+        migrated = migrate_points(conn, table_name)
+
+    # Reflect the table again, with the computed point column
+    registry.refresh(table_name)
+
+    log.info("Points of %s migrated: %s", table_name, migrated)
+
+    return {"migrated": migrated}
+
+
+@shared_task(bind=True, ignore_result=False)
+def maintain_rollups_task(self: Task):
+    # Check if the rollups are enabled
+    if not rollups_enabled(current_app.config):
+        log.info("Rollups not enabled, skipping")
+        return {"skipped": True}
+
+    # Get the database engine and the table registry
+    engine = get_engine(current_app.config["CONNECTION_STRING"], engine_options_from_config(current_app.config))
+    registry = get_registry(engine)
+
+    # Roll up the days marked at ingest time, the oldest first
+    done = maintain_rollups(engine, registry, current_app.config["ROLLUPS"].get("batch_size", DEFAULT_ROLLUP_BATCH))
+
+    log.info("Rollups maintained, %s days rolled up", done)
+
+    return {"days": done}
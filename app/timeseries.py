@@ -0,0 +1,155 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, Float
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from app.tracks import bucket_expression, iter_rows, format_time, DEFAULT_YIELD_PER
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The aggregates of the values in a time bucket
+AGGREGATES = ("avg", "min", "max", "last")
+
+# The aggregates needing numeric values
+NUMERIC_AGGREGATES = ("avg", "min", "max")
+
+# The maximum number of paths in a request
+MAX_PATHS = 10
+
+# The default number of points of the shared time grid of several paths
+DEFAULT_POINTS = 1000
+
+# The epoch, to convert the bucket numbers to timestamps
+EPOCH = datetime(1970, 1, 1)
+
+
+# Check if a path table stores numeric values
+def is_numeric(table):
+    return isinstance(table.c.value.type, Float)
+
+
+# Select the raw values of a vessel path in a time window (timestamp, value), oldest first
+def select_values(table, context, start, end):
+    statement = select(table.c.timestamp, table.c.value).where(
+        table.c.context == context,
+        table.c.timestamp >= start
+    )
+
+    # Check if the window is closed
+    if end is not None:
+        statement = statement.where(table.c.timestamp <= end)
+
+    return statement.order_by(table.c.timestamp)
+
+
+# Select the values of a vessel path aggregated in time buckets (bucket number, value), oldest first
+def select_buckets(dialect_name, table, context, start, end, bucket, aggregate):
+    # Get the bucket of each row
+    bucket_number = bucket_expression(dialect_name, table.c.timestamp, bucket).label("bucket")
+
+    # Get the aggregated value
+    if aggregate == "last":
+        if dialect_name == "postgresql":
+            # The value of the newest row of the bucket
+            value = func.array_agg(aggregate_order_by(table.c.value, table.c.timestamp.desc()))[1]
+            columns = [bucket_number, value]
+        else:
+            # SQLite takes the bare columns from the row having the max() value
+            columns = [bucket_number, table.c.value, func.max(table.c.timestamp)]
+    else:
+        columns = [bucket_number, getattr(func, aggregate)(table.c.value)]
+
+    statement = select(*columns).where(
+        table.c.context == context,
+        table.c.timestamp >= start
+    )
+
+    # Check if the window is closed
+    if end is not None:
+        statement = statement.where(table.c.timestamp <= end)
+
+    return statement.group_by(bucket_number).order_by(bucket_number)
+
+
+# Merge the bucketed series (iterators of (bucket number, value) sorted by bucket) on a shared time grid:
+# yield (bucket number, [value of each series or None])
+def merge_series(series):
+    iterators = [iter(rows) for rows in series]
+
+    # The next row of each series, None when exhausted
+    heads = [next(iterator, None) for iterator in iterators]
+
+    while True:
+        # Get the first bucket among the series
+        buckets = [int(head[0]) for head in heads if head is not None]
+        if not buckets:
+            return
+        bucket = min(buckets)
+
+        values = []
+        for index, head in enumerate(heads):
+            # Check if the series has a value in the bucket
+            if head is not None and int(head[0]) == bucket:
+                values.append(head[1])
+                heads[index] = next(iterators[index], None)
+            else:
+                values.append(None)
+
+        yield bucket, values
+
+
+# Stream the series as a JSON document
+def iter_json(header, rows, chunk_size=DEFAULT_YIELD_PER):
+    # Write the header, leaving the rows array open
+    yield json.dumps(header)[:-1] + ', "rows": ['
+
+    separator = ""
+    chunk = []
+    for row in rows:
+        chunk.append(separator + json.dumps(row))
+        separator = ", "
+
+        # Check if the chunk is full
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield "".join(chunk)
+
+    yield "]}\n"
+
+
+# Get the rows of the series of some paths of a vessel: [timestamp, value of each path]
+# The values are aggregated in buckets (seconds) if set, the raw values are available for a single path only.
+# The plans (one for each table, or None) read the bucketed series from the rollups instead of the path tables.
+def series_rows(engine, tables, context, start, end, bucket=None, aggregate="avg", yield_per=DEFAULT_YIELD_PER,
+                plans=None):
+    # Check if the raw values are requested
+    if bucket is None:
+        for timestamp, value in iter_rows(engine, select_values(tables[0], context, start, end), yield_per):
+            yield [format_time(timestamp), value]
+        return
+
+    # Check if any series is read from the rollups
+    if plans is None:
+        plans = [None] * len(tables)
+
+    # Read all the series at once, each from its own server-side cursor
+    series = [
+        plan.series(engine, context, start, end, bucket, aggregate, yield_per) if plan is not None else
+        iter_rows(engine, select_buckets(engine.dialect.name, table, context, start, end, bucket, aggregate),
+                  yield_per)
+        for table, plan in zip(tables, plans)
+    ]
+
+    try:
+        for bucket_number, values in merge_series(series):
+            yield [format_time(EPOCH + timedelta(seconds=bucket_number * bucket))] + values
+    finally:
+        # Give the connections back to the pool, even if the client went away
+        for rows in series:
+            rows.close()
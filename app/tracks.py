@@ -0,0 +1,318 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, func, cast, Integer, Text, null
+
+from app.database import connect
+
+# Create the logger
+log = logging.getLogger('app')
+
+# The format of the start and end arguments (i.e. 20230101Z120000)
+TIME_FORMAT = '%Y%m%dZ%H%M%S'
+
+# The default time window, when not specified
+DEFAULT_WINDOW = timedelta(minutes=15)
+
+# The number of rows fetched from the server-side cursor at time
+DEFAULT_YIELD_PER = 1000
+
+# Meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE_LAT = 110540.0
+METERS_PER_DEGREE_LON = 111320.0
+
+# The GPX document parts
+GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+             '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="dynamo-signalk-storage-server">' \
+             '<trk><trkseg>'
+GPX_FOOTER = '</trkseg></trk></gpx>\n'
+
+
+# Get the time window (start, end) of a request: start and end, or one of them and a duration
+# (hours, minutes, seconds), the last 15 minutes otherwise. The end is None when open.
+def time_window(args, now=None):
+    start = args.get('start')
+    end = args.get('end')
+    hours = args.get('hours')
+    minutes = args.get('minutes')
+    seconds = args.get('seconds')
+
+    # Check if a duration is set
+    has_duration = hours is not None or minutes is not None or seconds is not None
+
+    try:
+        if start is not None and end is not None:
+            return datetime.strptime(start, TIME_FORMAT), datetime.strptime(end, TIME_FORMAT)
+
+        if has_duration:
+            duration = timedelta(hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+
+            if start is not None:
+                start_time = datetime.strptime(start, TIME_FORMAT)
+                return start_time, start_time + duration
+
+            if end is not None:
+                end_time = datetime.strptime(end, TIME_FORMAT)
+                return end_time - duration, end_time
+
+    except ValueError as exception:
+        log.warning("Invalid time window: %s", exception)
+
+    # The timestamps are stored as UTC
+    if now is None:
+        now = datetime.utcnow()
+
+    return now - DEFAULT_WINDOW, None
+
+
+# Select the points of a vessel track in a time window (lon, lat, timestamp, source), oldest first
+def select_track(table, context, start, end):
+    statement = select(table.c.lon, table.c.lat, table.c.timestamp, table.c.source).where(
+        table.c.context == context,
+        table.c.timestamp >= start
+    )
+
+    # Check if the window is closed
+    if end is not None:
+        statement = statement.where(table.c.timestamp <= end)
+
+    return statement.order_by(table.c.timestamp)
+
+
+# Stream the rows of a statement from a server-side cursor, so the memory stays constant
+def iter_rows(engine, statement, yield_per=DEFAULT_YIELD_PER):
+    # The connection is given back to the pool when the generator completes or is closed
+    with connect(engine) as conn:
+        result = conn.execution_options(stream_results=True, yield_per=yield_per).execute(statement)
+        for row in result:
+            yield row
+
+
+# Format a timestamp as an ISO 8601 UTC time, as expected by GPX
+def format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+# Stream a GPX document from the track points (lon, lat, timestamp, source), in chunks of points
+def iter_gpx(points, chunk_size=DEFAULT_YIELD_PER):
+    yield GPX_HEADER
+
+    chunk = []
+    for lon, lat, timestamp, source in points:
+        chunk.append('<trkpt lat="' + str(lat) + '" lon="' + str(lon) + '"><time>' + format_time(timestamp) +
+                     '</time></trkpt>')
+
+        # Check if the chunk is full
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield "".join(chunk)
+
+    yield GPX_FOOTER
+
+
+# Get the seconds since the epoch of a timestamp column
+def epoch_seconds(dialect_name, column):
+    # Check if the database is PostgreSQL
+    if dialect_name == "postgresql":
+        return func.extract("epoch", column)
+
+    # SQLite
+    return cast(func.strftime("%s", column), Integer)
+
+
+# Get the number of the time bucket (seconds) of a timestamp column, counted from the epoch
+def bucket_expression(dialect_name, column, bucket):
+    epoch = epoch_seconds(dialect_name, column)
+
+    # Check if the database is PostgreSQL
+    if dialect_name == "postgresql":
+        return func.floor(epoch / bucket)
+
+    # SQLite
+    return cast(epoch / bucket, Integer)
+
+
+# Select the points of a vessel track averaged in time buckets (seconds), oldest first (the source is null)
+def select_bucketed_track(dialect_name, table, context, start, end, bucket):
+    # Get the bucket of each row
+    bucket_number = bucket_expression(dialect_name, table.c.timestamp, bucket)
+
+    # The timestamp of a bucket is the one of its first point
+    first_timestamp = func.min(table.c.timestamp)
+
+    statement = select(
+        func.avg(table.c.lon), func.avg(table.c.lat), first_timestamp, cast(null(), Text)
+    ).where(
+        table.c.context == context,
+        table.c.timestamp >= start
+    )
+
+    # Check if the window is closed
+    if end is not None:
+        statement = statement.where(table.c.timestamp <= end)
+
+    return statement.group_by(bucket_number).order_by(first_timestamp)
+
+
+# Get the bucket (seconds) reducing a time window to about a number of points
+def bucket_for_points(start, end, points):
+    # The open windows end now
+    if end is None:
+        end = datetime.utcnow()
+
+    return max(1, math.ceil((end - start).total_seconds() / points))
+
+
+# Read the track points in NumPy arrays (lon, lat, timestamp, source)
+def read_arrays(points):
+    lons = []
+    lats = []
+    timestamps = []
+    sources = []
+
+    for lon, lat, timestamp, source in points:
+        # Skip the positions without coordinates
+        if lon is None or lat is None:
+            continue
+
+        lons.append(lon)
+        lats.append(lat)
+        timestamps.append(timestamp)
+        sources.append(source)
+
+    return (np.array(lons, dtype=np.float64), np.array(lats, dtype=np.float64),
+            np.array(timestamps, dtype="datetime64[us]"), np.array(sources, dtype=object))
+
+
+# Simplify a track with the Douglas-Peucker algorithm, tolerance in meters; get the mask of the kept points
+def douglas_peucker(lons, lats, tolerance):
+    count = len(lons)
+    keep = np.zeros(count, dtype=bool)
+
+    # Check if there is anything to simplify
+    if count <= 2:
+        keep[:] = True
+        return keep
+
+    # Project the coordinates in meters (equirectangular, good enough for the tolerances of a track)
+    x = lons * METERS_PER_DEGREE_LON * math.cos(math.radians(float(np.mean(lats))))
+    y = lats * METERS_PER_DEGREE_LAT
+
+    keep[0] = keep[-1] = True
+
+    # The segments still to be checked
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+
+        # Check if the segment has inner points
+        if last - first < 2:
+            continue
+
+        # Get the distance of the inner points from the segment at once
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        inner_x = x[first + 1:last] - x[first]
+        inner_y = y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+
+        if length == 0:
+            distances = np.hypot(inner_x, inner_y)
+        else:
+            distances = np.abs(dx * inner_y - dy * inner_x) / length
+
+        # Get the farthest point
+        index = int(np.argmax(distances))
+
+        # Check if the farthest point must be kept
+        if distances[index] > tolerance:
+            index = first + 1 + index
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return keep
+
+
+class TrackCache:
+    """
+    In-process LRU cache of the simplified tracks, keyed by (vessel, range, tolerance).
+    The entries expire after a while, since a backlog parcel can still add points to a past range.
+    """
+
+    def __init__(self, size=128, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Check if the entry is missing or expired
+            if entry is None or entry[0] < time.monotonic():
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            # Drop the least recently used entries
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# The process-wide simplified tracks cache
+track_cache = TrackCache()
+
+
+# Get the points of a vessel track (lon, lat, timestamp, source), reduced as requested:
+# points: about this number of points, by time bucketing
+# bucket: points averaged in buckets of this number of seconds
+# tolerance: Douglas-Peucker simplification with this tolerance in meters
+def track_points(engine, table, context, start, end, points=None, bucket=None, tolerance=None,
+                 yield_per=DEFAULT_YIELD_PER):
+    # Check if the track must be reduced by time bucketing (in the database)
+    if points is not None and bucket is None:
+        bucket = bucket_for_points(start, end, points)
+
+    if bucket is not None:
+        statement = select_bucketed_track(engine.dialect.name, table, context, start, end, bucket)
+    else:
+        statement = select_track(table, context, start, end)
+
+    # Check if the track must be simplified
+    if tolerance is None:
+        return iter_rows(engine, statement, yield_per)
+
+    # Only the closed windows are cached, the open ones move with the time
+    key = (context, start, end, bucket, tolerance) if end is not None else None
+
+    # Check if the simplified track is cached
+    simplified = track_cache.get(key) if key is not None else None
+
+    if simplified is None:
+        # Read the track and simplify it
+        lons, lats, timestamps, sources = read_arrays(iter_rows(engine, statement, yield_per))
+        keep = douglas_peucker(lons, lats, tolerance)
+        simplified = list(zip(lons[keep].tolist(), lats[keep].tolist(), timestamps[keep].tolist(),
+                              sources[keep].tolist()))
+
+        # Cache the simplified track
+        if key is not None:
+            track_cache.put(key, simplified)
+
+    return simplified
@@ -1,7 +1,9 @@
 import gzip
 import io
 import json
+import mmap
 import tempfile
+import zlib
 from Crypto.Cipher import PKCS1_OAEP, AES
 
 from hashlib import sha256
@@ -16,6 +18,12 @@ from os import listdir
 from os.path import isdir, isfile, join
 
 from app.storage import store_updatelist_csv
+from app.keys import key_cache
+from app.decoders import get_decoder
+from app.metrics import StageTimer
+
+# Size of the chunks read from the encrypted parcel
+CHUNK_SIZE = 64 * 1024
 
 
 def verify_sign(public_key_loc, signature, data):
@@ -27,11 +35,21 @@ def verify_sign(public_key_loc, signature, data):
     return: Boolean. True if the signature is valid; False otherwise.
     '''
 
-    pub_key = open(public_key_loc, "r").read()
-    rsakey = RSA.importKey(pub_key)
-    signer = PKCS1_v1_5.new(rsakey)
     digest = SHA256.new()
     digest.update(data.encode("utf-8"))
+    return verify_digest(public_key_loc, signature, digest)
+
+
+def verify_digest(public_key_loc, signature, digest):
+    '''
+    Verifies the signature of data already hashed with SHA256
+    param: public_key_loc Path to public key
+    param: signature String signature to be verified
+    param: digest SHA256 hash object fed with the signed data
+    return: Boolean. True if the signature is valid; False otherwise.
+    '''
+
+    signer = key_cache.verifier(public_key_loc)
     if signer.verify(digest, b64decode(signature)):
         return True
     return False
@@ -56,58 +74,133 @@ def get_encoded_encrypted_symmetric_key(src_path, enc_path):
     return encoded_encrypted_symmetric_key
 
 
+def read_key_header(src_path):
+    '''
+    Reads the key header of a parcel without copying the encrypted body
+    param: src_path Path to the parcel as uploaded (key header line + iv + AES-CBC ciphertext)
+    return: Tuple (encoded encrypted symmetric key, offset of the iv in the file)
+    '''
+    with open(src_path, "rb") as f_in:
+        encoded_encrypted_symmetric_key = f_in.readline().decode('utf-8')
+        offset = f_in.tell()
+
+    return encoded_encrypted_symmetric_key, offset
+
+
 def get_symmetric_key(private_key_filename, encoded_encrypted_symmetric_key):
-    rsa_key = RSA.importKey(open(private_key_filename, "rb").read())
-    rsa_key = PKCS1_OAEP.new(rsa_key)
+    rsa_key = key_cache.decryptor(private_key_filename)
     decoded_encrypted_symmetric_key = b64decode(encoded_encrypted_symmetric_key)
     symmetric_key = rsa_key.decrypt(decoded_encrypted_symmetric_key)
     return symmetric_key
 
 
-def uncrypt_update_list(public_key_filename, symmetric_key, enc_path):
-    update_list = []
-    with open(enc_path, mode='rb') as f_in:
-        enc = bytearray(f_in.read())
+def uncrypt_update_list(public_key_filename, symmetric_key, enc_path, offset=0, decoder=None):
+    return list(iter_update_list(public_key_filename, symmetric_key, enc_path, offset, decoder))
 
-        iv = enc[:16]
-        # print ("len(iv):"+str(len(iv)))
-        # print ','.join('{:02x}'.format(x) for x in iv)
 
-        m = sha256()
-        m.update(symmetric_key)
-        key = m.digest()
-        aes = AES.new(key, AES.MODE_CBC, iv)
-        result = unpad(aes.decrypt(enc[16:]))
+def iter_decrypted(view, aes, chunk_size=CHUNK_SIZE):
+    # The chunk size must be a multiple of the AES block size, the padding is removed from the last chunk
+    if len(view) % AES.block_size:
+        raise ValueError('Ciphertext length is not a multiple of the AES block size')
 
-        # bbb=bytearray(result)
-        # print ','.join('{:02x}'.format(x) for x in bbb)
+    for start in range(0, len(view), chunk_size):
+        plain = aes.decrypt(view[start:start + chunk_size])
+        if start + chunk_size >= len(view):
+            plain = unpad(plain)
+        yield plain
 
-        in_ = io.BytesIO()
-        in_.write(result)
-        in_.seek(0)
-        with gzip.GzipFile(fileobj=in_, mode='rb') as fo:
-            gunzipped_bytes_obj = fo.read()
 
-        result = gunzipped_bytes_obj.decode()
+def iter_gunzipped(chunks):
+    # Accept multi-member gzip streams as gzip.GzipFile does
+    gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = gunzip.decompress(chunk)
+            if data:
+                yield data
+            chunk = b""
+            if gunzip.eof:
+                chunk = gunzip.unused_data
+                gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = gunzip.flush()
+    if data:
+        yield data
 
-        lines = result.splitlines()
-        meta_data = json.loads(lines[0])
-        encrypted_signature = meta_data["signature"]
-        # print ("Encrypted Signature:" + encrypted_signature)
 
-        log_file = ''.join(line + "\n" for line in lines[1:])
+def iter_lines(chunks):
+    tail = b""
+    for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if tail:
+        yield tail.rstrip(b"\r")
 
-        if encrypted_signature is not None:
-            if verify_sign(public_key_filename, encrypted_signature, log_file):
-                for line in lines[1:]:
-                    update_list.append(json.loads(line))
-            else:
-                raise ValueError('Invalid signature')
 
-    return update_list
+def iter_update_list(public_key_filename, symmetric_key, enc_path, offset=0, decoder=None, timer=None):
+    '''
+    Streams a parcel: decrypts AES-CBC in chunks, gunzips, hashes and parses it line by line.
+    The signature is verified once the last update has been yielded: the consumer must make
+    the updates durable only when the generator completes without raising ValueError.
+    param: public_key_filename Path to the vessel public key
+    param: symmetric_key The decrypted symmetric key
+    param: enc_path Path to the encrypted parcel
+    param: offset Position of the iv in the file (i.e. the length of the key header of an uploaded parcel)
+    param: decoder Function decoding a JSON line from bytes (the fastest available one by default)
+    param: timer StageTimer measuring the aes_decrypt, gunzip, verify and parse stages (optional)
+    return: Generator of update dicts
+    '''
+    if decoder is None:
+        decoder = get_decoder()
+
+    if timer is None:
+        timer = StageTimer()
+
+    with open(enc_path, mode='rb') as f_in, mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        iv = mm[offset:offset + 16]
+
+        m = sha256()
+        m.update(symmetric_key)
+        key = m.digest()
+        aes = AES.new(key, AES.MODE_CBC, iv)
+
+        # Decrypt directly from the mapped file, no copy of the encrypted body is made
+        body = memoryview(mm)[offset + 16:]
+        lines = timer.iterate("gunzip", iter_lines(iter_gunzipped(timer.iterate("aes_decrypt",
+                                                                                iter_decrypted(body, aes)))))
+        try:
+            with timer.stage("parse"):
+                meta_data = decoder(next(lines))
+            encrypted_signature = meta_data["signature"]
+            # print ("Encrypted Signature:" + encrypted_signature)
+
+            if encrypted_signature is None:
+                return
+
+            digest = SHA256.new()
+            for line in lines:
+                with timer.stage("verify"):
+                    digest.update(line + b"\n")
+                if line.strip():
+                    with timer.stage("parse"):
+                        update = decoder(line)
+                    yield update
+
+            with timer.stage("verify"):
+                verified = verify_digest(public_key_filename, encrypted_signature, digest)
+
+            if not verified:
+                raise ValueError('Invalid signature')
+        finally:
+            # Drop the generators referencing the mapped memory before the map is closed
+            lines.close()
+            del lines
+            body.release()
 
 
 def process_updates(media_root, scratch_root, trash_root, csv_root, private_key_filename, public_key_root):
+    # The scratch root is not used anymore: the parcels are decrypted in place
     vessels = [f for f in listdir(media_root) if isdir(join(media_root, f))]
     for vessel in vessels:
         public_key_filename = public_key_root + "/" + vessel + "-public.pem"
@@ -115,21 +208,13 @@ def process_updates(media_root, scratch_root, trash_root, csv_root, private_key_
         files = [f for f in listdir(vessel_root) if isfile(join(vessel_root, f))]
         for file in files:
             src_path = vessel_root + "/" + file
-            try:
-                os.mkdir(scratch_root + "/" + vessel)
-            except:
-                pass
-            scratch_dir = tempfile.mkdtemp(dir=scratch_root + "/" + vessel)
-            enc_path = scratch_dir + "/" + file
 
-            encoded_encrypted_symmetric_key = get_encoded_encrypted_symmetric_key(src_path, enc_path)
+            encoded_encrypted_symmetric_key, offset = read_key_header(src_path)
 
             symmetric_key = get_symmetric_key(private_key_filename, encoded_encrypted_symmetric_key)
-            update_list = uncrypt_update_list(public_key_filename, symmetric_key, enc_path)
+            update_list = uncrypt_update_list(public_key_filename, symmetric_key, src_path, offset)
             store_updatelist_csv(update_list, {"csv_root": csv_root})
 
-            shutil.rmtree(scratch_dir)
-
             try:
                 os.mkdir(trash_root + "/" + vessel)
             except:
@@ -0,0 +1,296 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+
+from werkzeug.formparser import FormDataParser
+
+# The extension of a parcel ready to be processed
+PARCEL_SUFFIX = ".log.gz.enc"
+
+# The extension of a parcel still being written (the file is also hidden, starting with a dot)
+PART_SUFFIX = ".part"
+
+# Size of the chunks read from the request stream
+CHUNK_SIZE = 64 * 1024
+
+# The format of a resumable upload id
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class ParcelWriter:
+    """
+    Writes an uploaded parcel straight into the vessel media directory, hashing it while it is written.
+    The data goes to a hidden, exclusively created (O_EXCL) part file, renamed as a parcel by commit().
+    The object is also usable as a Werkzeug stream factory container.
+    """
+
+    def __init__(self, destination):
+        # Make the directory if needed
+        os.makedirs(destination, exist_ok=True)
+
+        self.destination = destination
+
+        # Create the part file (mkstemp uses O_CREAT | O_EXCL)
+        fd, self.part_path = tempfile.mkstemp(dir=destination, prefix=".", suffix=PART_SUFFIX)
+        self.file = os.fdopen(fd, "wb")
+
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.file_name = None
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Werkzeug rewinds the container once the part is complete, nothing to do for a write-only file
+        return self.file.tell()
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    # Copy a binary stream into the parcel
+    def write_stream(self, stream, chunk_size=CHUNK_SIZE):
+        data = stream.read(chunk_size)
+        while data:
+            self.write(data)
+            data = stream.read(chunk_size)
+
+    # Get the hex digest of the written content
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    # Publish the parcel in the media directory and get its file name
+    def commit(self):
+        self.file.close()
+
+        # Link the part file under a unique parcel name (os.link never overwrites an existing file)
+        while True:
+            file_name = secrets.token_hex(8) + PARCEL_SUFFIX
+            try:
+                os.link(self.part_path, os.path.join(self.destination, file_name))
+                break
+            except FileExistsError:
+                pass
+
+        os.unlink(self.part_path)
+
+        self.file_name = file_name
+        return file_name
+
+    # Discard the parcel
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.part_path)
+        except FileNotFoundError:
+            pass
+
+
+# Check if a file in a vessel media directory is a parcel ready to be processed
+def is_parcel(file_name):
+    return not file_name.startswith(".")
+
+
+# Receive a parcel from a raw application/octet-stream request body
+def receive_raw(stream, destination):
+    writer = ParcelWriter(destination)
+    try:
+        writer.write_stream(stream)
+    except Exception:
+        writer.abort()
+        raise
+
+    return writer
+
+
+# Receive a parcel from a multipart/form-data request, streaming the "file" part to disk
+def receive_multipart(environ, destination, field="file"):
+    # The writers created by the parser, one for each file part
+    writers = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        writer = ParcelWriter(destination)
+        writers.append(writer)
+        return writer
+
+    try:
+        _, form, files = FormDataParser(stream_factory=stream_factory).parse_from_environ(environ)
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    # Get the parcel part
+    uploaded_file = files.get(field)
+    writer = uploaded_file.stream if uploaded_file is not None else None
+
+    # Discard any other file part
+    for other in writers:
+        if other is not writer:
+            other.abort()
+
+    return writer, uploaded_file, form
+
+
+class ResumableUpload:
+    """
+    A parcel uploaded in chunks over several requests.
+    The chunks are written at their offset in UPLOAD_ROOT/<self_id>/<upload_id>/data, the received byte
+    ranges are kept in state.json next to it, so an upload survives a server restart.
+    """
+
+    def __init__(self, upload_root, self_id, upload_id):
+        # Check the upload id, it is used as a directory name
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            raise ValueError("Invalid upload id")
+
+        self.self_id = self_id
+        self.upload_id = upload_id
+        self.directory = os.path.join(upload_root, str(self_id), upload_id)
+        self.data_path = os.path.join(self.directory, "data")
+        self.state_path = os.path.join(self.directory, "state.json")
+        self.lock_path = os.path.join(self.directory, "lock")
+
+    # Start a new upload
+    @classmethod
+    def create(cls, upload_root, self_id, size=None, sha256=None):
+        upload = cls(upload_root, self_id, secrets.token_hex(16))
+
+        os.makedirs(upload.directory)
+        open(upload.data_path, "wb").close()
+        upload.save_state({"size": size, "sha256": sha256, "ranges": []})
+
+        return upload
+
+    def exists(self):
+        return os.path.isfile(self.state_path)
+
+    def load_state(self):
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    # Write the state atomically
+    def save_state(self, state):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    # Write a chunk at its offset and get the updated state
+    def write_chunk(self, offset, stream, length=None, chunk_size=CHUNK_SIZE):
+        state = self.load_state()
+
+        # Check the chunk is inside the declared size
+        if offset < 0 or (state["size"] is not None and length is not None and offset + length > state["size"]):
+            raise ValueError("Chunk out of the upload range")
+
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            position = offset
+            data = stream.read(chunk_size)
+            while data:
+                os.pwrite(fd, data, position)
+                position += len(data)
+                data = stream.read(chunk_size)
+
+            # Make the chunk durable before it is recorded as received
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if length is not None and position - offset != length:
+            raise ValueError("Chunk shorter than declared")
+
+        # Record the received range (the lock serializes concurrent chunks of the same upload)
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load_state()
+            state["ranges"] = merge_ranges(state["ranges"] + [[offset, position]])
+            self.save_state(state)
+
+        return state
+
+    # Check if all the bytes have been received
+    def is_complete(self, state):
+        size = state["size"]
+        ranges = state["ranges"]
+
+        if size is None:
+            return len(ranges) == 1 and ranges[0][0] == 0
+
+        return size == 0 or (len(ranges) == 1 and ranges[0] == [0, size])
+
+    # Move the assembled parcel in the vessel media directory and get its file name, size and hash
+    def finalize(self, destination):
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Check the upload has not been finalized by a concurrent request
+            if not self.exists():
+                raise FileNotFoundError("Upload not found")
+
+            return self._finalize(destination)
+
+    def _finalize(self, destination):
+        state = self.load_state()
+
+        if not self.is_complete(state):
+            raise ValueError("Upload not complete")
+
+        os.makedirs(destination, exist_ok=True)
+
+        # Hash the assembled parcel
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(self.data_path, "rb") as f:
+            data = f.read(CHUNK_SIZE)
+            while data:
+                sha256.update(data)
+                size += len(data)
+                data = f.read(CHUNK_SIZE)
+
+        if state["sha256"] is not None and state["sha256"] != sha256.hexdigest():
+            raise ValueError("Checksum mismatch")
+
+        # Link the parcel under a unique name (UPLOAD_ROOT and MEDIA_ROOT must be on the same file system)
+        while True:
+            file_name = secrets.token_hex(8) + PARCEL_SUFFIX
+            try:
+                os.link(self.data_path, os.path.join(destination, file_name))
+                break
+            except FileExistsError:
+                pass
+
+        self.abort()
+
+        return file_name, size, sha256.hexdigest()
+
+    # Remove the upload state and data
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Merge overlapping or adjacent [start, end) ranges
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
@@ -0,0 +1,59 @@
+"""
+Compare the JSON decoders on the delta lines of a synthetic NMEA-derived parcel (GPS RMC and wind MWV sentences).
+
+No database is needed, only the decoding of the lines is measured:
+
+    python -m benchmarks.json_benchmark [updates]
+"""
+import json
+import sys
+import time
+
+from app.decoders import BUILDERS, get_decoder
+from benchmarks.synthetic import make_context, make_update_list
+
+
+# Decode the lines as str, as the parcels used to be decoded
+def decode_str(lines):
+    return [json.loads(line.decode("utf-8")) for line in lines]
+
+
+# Decode the lines as bytes
+def decode_bytes(lines, decoder):
+    return [decoder(line) for line in lines]
+
+
+def measure(function, *args):
+    t0 = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - t0
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    # Serialize the update list as the delta lines of a parcel
+    lines = [json.dumps(update_item).encode("utf-8") for update_item in make_update_list(make_context(), updates)]
+    size = sum(len(line) for line in lines)
+
+    print("lines: %d (%.1f MB)" % (len(lines), size / 1e6))
+
+    baseline = measure(decode_str, lines)
+    print("json (str): %.1f lines/s (%.2f s)" % (len(lines) / baseline, baseline))
+
+    # For each decoder available
+    for name in BUILDERS:
+        try:
+            decoder = get_decoder(name)
+        except ValueError:
+            print(name + ": not available")
+            continue
+
+        elapsed = measure(decode_bytes, lines, decoder)
+        print("%s (bytes): %.1f lines/s (%.2f s), speedup: %.1fx" % (
+            name, len(lines) / elapsed, elapsed, baseline / elapsed
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare the rows/second of the columnar parser against the former per-row parsing of store_updatelist.
+
+No database is needed, only the parsing stage is measured:
+
+    python -m benchmarks.parse_benchmark [updates] [batch_size]
+"""
+import datetime
+import sys
+import time
+
+from app.columnar import ColumnarParser
+from app.storage import DEFAULT_BATCH_SIZE
+from benchmarks.synthetic import make_context, make_update_list, count_values
+
+
+# Parse the update list one row at time, as store_updatelist used to do
+def parse_row_by_row(update_list):
+    rows = []
+    for update_item in update_list:
+        context = update_item["context"]
+        for update in update_item["updates"]:
+            timestamp = datetime.datetime.strptime(update["timestamp"], '%Y-%m-%dT%H:%M:%S.%fZ')
+            source_ref = update["source"]["label"]
+            for value in update["values"]:
+                path = value["path"]
+                value_data = value["value"]
+                params = {"context": context, "timestamp": timestamp, "source": source_ref, "value": value_data}
+                if path == "navigation.position":
+                    params["lon"] = value_data["longitude"]
+                    params["lat"] = value_data["latitude"]
+                    params["point"] = "POINT (" + str(value_data["latitude"]) + " " + str(value_data["longitude"]) + ")"
+                rows.append(params)
+    return rows
+
+
+# Parse the update list into column batches
+def parse_columnar(update_list, batch_size):
+    parser = ColumnarParser(batch_size)
+    batches = []
+    for update_item in update_list:
+        batches.extend(parser.feed(update_item))
+    batches.extend(parser.drain())
+    return batches
+
+
+def measure(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+
+    update_list = make_update_list(make_context(), updates)
+    rows = count_values(update_list)
+
+    _, row_by_row = measure(parse_row_by_row, update_list)
+    batches, columnar = measure(parse_columnar, update_list, batch_size)
+    _, to_rows = measure(lambda: [batch.rows() for batch in batches])
+
+    print("rows: " + str(rows))
+    print("row by row: %.1f rows/s (%.2f s)" % (rows / row_by_row, row_by_row))
+    print("columnar (batch_size=%d): %.1f rows/s (%.2f s)" % (batch_size, rows / columnar, columnar))
+    print("columnar + INSERT parameters: %.1f rows/s (%.2f s)" % (rows / (columnar + to_rows), columnar + to_rows))
+    print("speedup: %.1fx" % (row_by_row / columnar))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import datetime
+import math
+import uuid
+
+
+# Create a synthetic vessel context, unique for each benchmark run
+def make_context():
+    return "vessels.urn:mrn:signalk:uuid:" + str(uuid.uuid4())
+
+
+# Create a synthetic update list resembling a parcel sent by a vessel with a GPS and a wind sensor
+def make_update_list(context, updates=1000, start=None):
+    # Set the start time
+    if start is None:
+        start = datetime.datetime(2023, 1, 1)
+
+    update_list = []
+
+    # For each update
+    for i in range(updates):
+
+        # Compute the timestamp as a 1 Hz sample
+        timestamp = (start + datetime.timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + "Z"
+
+        update_list.append({
+            "context": context,
+            "updates": [
+                {
+                    "source": {"sentence": "RMC", "talker": "GP", "type": "NMEA0183", "label": "USB1"},
+                    "timestamp": timestamp,
+                    "values": [
+                        {
+                            "path": "navigation.position",
+                            "value": {"longitude": 14.25 + i * 1e-5, "latitude": 40.83 + math.sin(i / 100) * 1e-3}
+                        },
+                        {"path": "navigation.courseOverGroundTrue", "value": 4.032583237653657},
+                        {"path": "navigation.speedOverGround", "value": 3.2 + math.cos(i / 50)},
+                        {"path": "navigation.gnss.methodQuality", "value": "GNSS Fix"}
+                    ]
+                },
+                {
+                    "source": {"sentence": "MWV", "talker": "WI", "type": "NMEA0183", "label": "USB2"},
+                    "timestamp": timestamp,
+                    "values": [
+                        {"path": "environment.wind.speedApparent", "value": 6.1 + math.sin(i / 10)},
+                        {"path": "environment.wind.angleApparent", "value": 0.7 + math.cos(i / 10)}
+                    ]
+                }
+            ]
+        })
+
+    return update_list
+
+
+# Count the values in an update list
+def count_values(update_list):
+    return sum(len(update["values"]) for update_item in update_list for update in update_item["updates"])
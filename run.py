@@ -4,21 +4,7 @@ from app import create_app
 # Create the logger
 log = logging.getLogger('app')
 
-# Set the default logger level as debug
-log.setLevel(logging.DEBUG)
-
-# Create the logger formatter
-fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
-
-# Get the handler
-h = logging.StreamHandler()
-
-# Set the formatter
-h.setFormatter(fmt)
-
-# Add the handler to the logger
-log.addHandler(h)
-
-log.info("The app is up")
 flask_app = create_app()
 celery_app = flask_app.extensions["celery"]
+
+log.info("The app is up")